@@ -20,23 +20,46 @@ Todo:
 2. Fix streaming so u can stream multiple commands (maybe an empty line in the kubebox client will cause streaming to end prematurely?)
 """
 
-from typing import List
-from fastapi import FastAPI, HTTPException, Request
-from pydantic import BaseModel
+from typing import List, Optional
+from functools import lru_cache, partial
+from fastapi import FastAPI, HTTPException, Query, Request
 from enum import Enum
 import socketio
-import subprocess
 import asyncio
 import uuid
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse
 import os
 import re
+import signal
+import json
+import types
+import codecs
+import orjson
+import msgspec
 from loguru import logger
 
 print = logger.info
 
 app = FastAPI()
 
+STREAM_READ_SIZE = 64 * 1024
+MAX_STREAMS_PER_SESSION = 16
+# Set SANDBOX_PERSISTENT_SHELL=0 to give every WAIT command its own shell
+PERSISTENT_SHELL = os.environ.get("SANDBOX_PERSISTENT_SHELL", "1") != "0"
+# Seconds a session's streams outlive its client's socket, waiting for the
+# client to reconnect and re-initialize, before they are cancelled
+DISCONNECT_GRACE = float(os.environ.get("SANDBOX_DISCONNECT_GRACE", "30"))
+
+# Drop-in for the stdlib json module. Socket.IO packets are msgpack-encoded,
+# so this only covers what engineio still sends as JSON (e.g. the handshake).
+# engineio passes separators=..., which orjson's compact output already matches.
+orjson_json = types.SimpleNamespace(
+    dumps=lambda obj, **kwargs: orjson.dumps(
+        obj, option=orjson.OPT_NON_STR_KEYS
+    ).decode(),
+    loads=orjson.loads,
+)
+
 
 class SocketManager:
     def __init__(self):
@@ -50,6 +73,10 @@ class SocketManager:
             max_http_buffer_size=10_000_000,
             cors_allowed_origins="*",
             ping_timeout=60,
+            # Binary frames: output lines go out as raw msgpack strings
+            # instead of escaped JSON. Clients must use the same serializer.
+            serializer="msgpack",
+            json=orjson_json,
         )
         self.socket_app = socketio.ASGIApp(socketio_server=self.sio)
         self.app = app
@@ -64,7 +91,7 @@ class SocketManager:
 
     async def emit(self, *args, **kwargs):
         # event: str, data: dict, to: str
-        print(f"Emitting event {kwargs}")
+        logger.debug("Emitting event {}", kwargs)
         await self.sio.emit(*args, **kwargs)
 
 
@@ -72,26 +99,72 @@ sio = SocketManager()
 sio.initialize(app)
 
 
-class InitType(BaseModel):
+class ExecutionMode(str, Enum):
+    WAIT = "wait"
+    BACKGROUND = "background"
+    STREAM = "stream"
+
+
+# Request bodies are decoded straight from the raw bytes with msgspec
+class InitType(msgspec.Struct):
     session_id: str
     path: str
 
 
-class InitResponse(BaseModel):
+class InitResponse(msgspec.Struct):
     session_id: str
 
 
-class ExecutionMode(str, Enum):
-    WAIT = "wait"
-    BACKGROUND = "background"
-    STREAM = "stream"
+class RunCommandRequest(msgspec.Struct):
+    session_id: str
+    command: str
+    path: str | None = None
+    mode: ExecutionMode = ExecutionMode.WAIT
+    timeout: float | None = 10
+    # Stream mode only: send stderr down stdout's pipe (one pipe, one reader)
+    merge_stderr: bool = False
+
+
+class KillCommandRequest(msgspec.Struct):
+    session_id: str
+    process_id: int
+
+
+class WriteFileRequest(msgspec.Struct):
+    session_id: str
+    file_path: str
+    content: str
+    make_dirs: bool = False
+
+
+class FilePathRequest(msgspec.Struct):
+    session_id: str
+    file_path: str
+
+
+init_decoder = msgspec.json.Decoder(InitType)
+run_command_decoder = msgspec.json.Decoder(RunCommandRequest)
+# Not strict, so a process_id sent as a string still finds the process
+kill_command_decoder = msgspec.json.Decoder(KillCommandRequest, strict=False)
+write_file_decoder = msgspec.json.Decoder(WriteFileRequest)
+file_path_decoder = msgspec.json.Decoder(FilePathRequest)
+
+
+async def decode_body(request: Request, decoder: msgspec.json.Decoder):
+    try:
+        return decoder.decode(await request.body())
+    except msgspec.DecodeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
 
 class Process:
+    __slots__ = ("pid", "process", "exit_code", "streaming", "_stdout", "_stderr")
+
     def __init__(self, pid, process=None, stdout=None, stderr=None):
         self.pid = pid
         self.process = process  # Store the actual asyncio subprocess
         self.exit_code = None
+        self.streaming = False
         self._stdout = stdout
         self._stderr = stderr
 
@@ -124,15 +197,175 @@ class Process:
             self.process.terminate()
 
 
+class Shell:
+    """Long-lived bash used to run WAIT commands without a fork/exec each.
+
+    Every command is sent as a NUL-terminated (cwd, command) pair and runs in
+    a subshell with stdin from /dev/null, so it starts in the requested
+    directory and cannot eat the protocol. Once it exits, the driver writes
+    the exit code and a random token to stdout and the token to stderr,
+    which is how we know both pipes are drained.
+    """
+
+    __slots__ = ("process", "marker", "lock")
+
+    SCRIPT = r"""
+token=$1
+while IFS= read -r -d '' dir && IFS= read -r -d '' cmd; do
+    ( [ -z "$dir" ] || cd "$dir" && eval "$cmd" ) </dev/null
+    printf '\0%d\0%s\0' "$?" "$token"
+    printf '\0%s\0' "$token" >&2
+done
+"""
+
+    def __init__(self):
+        self.process = None
+        self.marker = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def busy(self):
+        return self.lock.locked()
+
+    async def _spawn(self):
+        token = uuid.uuid4().hex
+        self.marker = b"\0" + token.encode() + b"\0"
+        # Own process group, so a timeout can take the running command down too
+        self.process = await asyncio.create_subprocess_exec(
+            "/bin/bash",
+            "-c",
+            self.SCRIPT,
+            "sandbox-shell",
+            token,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+        )
+
+    async def _read_until_marker(self, stream):
+        buffer = bytearray()
+        while True:
+            chunk = await stream.read(STREAM_READ_SIZE)
+            if not chunk:
+                return buffer, False
+            start = max(0, len(buffer) - len(self.marker))
+            buffer.extend(chunk)
+            end = buffer.find(self.marker, start)
+            if end != -1:
+                del buffer[end:]
+                return buffer, True
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        """Spawns the shell ahead of the first command."""
+        async with self.lock:
+            if not self.running:
+                await self._spawn()
+
+    async def run(self, command, cwd=None, timeout=None):
+        """Returns (stdout, stderr, exit_code); raises asyncio.TimeoutError."""
+        async with self.lock:
+            if not self.running:
+                await self._spawn()
+            process = self.process
+            process.stdin.write(f"{cwd or ''}\0{command}\0".encode())
+            try:
+                await process.stdin.drain()
+                (stdout, finished), (stderr, _) = await asyncio.wait_for(
+                    asyncio.gather(
+                        self._read_until_marker(process.stdout),
+                        self._read_until_marker(process.stderr),
+                    ),
+                    timeout=timeout,
+                )
+            except BaseException:
+                # Timed out, lost its pipes or cancelled: the shell is stuck
+                # mid-command, and its leftover output would go to the next one
+                self.close()
+                await process.wait()
+                raise
+
+            if not finished:
+                # The command took the shell down with it (exit, exec, ...)
+                self.process = None
+                return bytes(stdout), bytes(stderr), await process.wait()
+
+            stdout, _, exit_code = stdout.rpartition(b"\0")
+            return bytes(stdout), bytes(stderr), int(exit_code)
+
+    def close(self):
+        if self.running:
+            try:
+                os.killpg(self.process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.process = None
+
+
 class Session:
+    __slots__ = (
+        "session_id",
+        "path",
+        "sid",
+        "active_processes",
+        "tasks",
+        "shell",
+        "stream_slots",
+        "orphan_timer",
+        "reattached",
+    )
+
     def __init__(self, session_id, path, sid=None):
         self.session_id = session_id
         self.path = path
         self.sid = sid
         self.active_processes = {}
+        self.tasks = set()
+        self.shell = Shell()
+        self.stream_slots = asyncio.Semaphore(MAX_STREAMS_PER_SESSION)
+        # Set while the client is away: cancels the tasks once the grace
+        # period runs out, and resolves `reattached` either way
+        self.orphan_timer = None
+        self.reattached = None
 
     def set_sid(self, sid):
         self.sid = sid
+        if sid is not None:
+            if self.orphan_timer is not None:
+                self.orphan_timer.cancel()
+                self.orphan_timer = None
+            self._resolve_reattached(True)
+        elif self.tasks and self.orphan_timer is None:
+            # A dropped connection doesn't stop the streams right away, so a
+            # client that reconnects picks them up where they were
+            loop = asyncio.get_running_loop()
+            self.reattached = loop.create_future()
+            self.orphan_timer = loop.call_later(DISCONNECT_GRACE, self._orphaned)
+
+    def _resolve_reattached(self, value):
+        if self.reattached is not None:
+            if not self.reattached.done():
+                self.reattached.set_result(value)
+            self.reattached = None
+
+    def _orphaned(self):
+        self.orphan_timer = None
+        # Wake the waiters first, so they drop their output rather than
+        # block the cancelled streams from winding down
+        self._resolve_reattached(False)
+        self.cancel_tasks()
+
+    async def wait_for_client(self):
+        """Returns the sid to emit to, first waiting out a disconnect's grace
+        period for the client to come back. None if it didn't."""
+        if self.sid is None and self.reattached is not None:
+            # Shielded: a cancelled waiter mustn't cancel it for the others
+            await asyncio.shield(self.reattached)
+        return self.sid
 
     def add_process(self, process):
         self.active_processes[process.pid] = process
@@ -143,17 +376,32 @@ class Session:
     def get_process(self, process_id):
         return self.active_processes.get(process_id)
 
+    def add_task(self, task):
+        # Hold a strong reference until the task finishes
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def cancel_tasks(self):
+        for task in list(self.tasks):
+            task.cancel()
+
 
 class SessionManager:
+    __slots__ = ("sessions", "sid_to_session", "get_session")
+
     def __init__(self):
         self.sessions = {}
+        self.sid_to_session = {}
+        # Looked up on every request and event; bind the dict's own get so
+        # a lookup is a single C call. `sessions` must never be rebound.
+        self.get_session = self.sessions.get
 
     def create_session(self, session_id, path):
+        previous = self.sessions.get(session_id)
+        if previous:
+            previous.shell.close()
         self.sessions[session_id] = Session(session_id, path)
 
-    def get_session(self, session_id):
-        return self.sessions.get(session_id)
-
     def add_process(self, session_id, process):
         session = self.get_session(session_id)
         if session:
@@ -172,34 +420,284 @@ class SessionManager:
     def set_session_sid(self, session_id, sid):
         session = self.get_session(session_id)
         if session:
+            if session.sid is not None:
+                self.sid_to_session.pop(session.sid, None)
             session.set_sid(sid)
+            self.sid_to_session[sid] = session
 
     def get_session_by_sid(self, sid):
-        for session in self.sessions.values():
-            if session.sid == sid:
-                return session
-        return None
+        return self.sid_to_session.get(sid)
+
+    def clear_sid(self, sid):
+        session = self.sid_to_session.pop(sid, None)
+        if session and session.sid == sid:
+            # Don't keep emitting to a socket that's gone
+            session.set_sid(None)
+        return session
 
 
 session_manager = SessionManager()
 
 
+# Queued by OutputBatcher's timer to wake its run loop
+_FLUSH = object()
+
+
+class OutputBatcher:
+    """Coalesces a process's streamed lines into `command_output_batch` emits.
+
+    Both pipes feed one batcher, so stdout and stderr lines keep the order
+    they were read in. A batch is flushed once it holds `max_lines` lines or
+    `max_delay` seconds after its first line, whichever comes first. No
+    single emit carries more than `max_items` lines or `max_chars`
+    characters, cutting a longer line into pieces, so every message stays
+    well under the websocket message limit (4 MiB in aiohttp clients).
+
+    Emits are asked for an ack, which a Socket.IO client sends once its
+    handler has taken the batch, and at most `max_in_flight` batches go
+    unacked. A client that stops reading therefore stops the emits; the
+    reader then waits on the bounded queue's `put`, and the command on its
+    pipe, instead of output piling up in the socket's send queue.
+
+    Every event, the closing `command_exit` included, carries a `seq` and is
+    kept until acked. When the client comes back on a new socket, whatever
+    the old one left unacked is sent again, in order, before anything new;
+    the client skips the ones it already took.
+    """
+
+    __slots__ = (
+        "session",
+        "process_id",
+        "max_lines",
+        "max_delay",
+        "max_items",
+        "max_chars",
+        "queue",
+        "items",
+        "timer",
+        "due",
+        "max_in_flight",
+        "seq",
+        "unacked",
+        "window_sid",
+        "acked",
+    )
+
+    def __init__(
+        self,
+        session,
+        process_id,
+        max_lines=32,
+        max_delay=0.025,
+        max_items=256,
+        max_chars=256 * 1024,
+        max_pending=256,
+        max_in_flight=8,
+    ):
+        self.session = session
+        self.process_id = process_id
+        self.max_lines = max_lines
+        self.max_delay = max_delay
+        self.max_items = max_items
+        # At most 4 bytes per character once UTF-8 encoded
+        self.max_chars = max_chars
+        self.queue = asyncio.Queue(max_pending)
+        self.items = []
+        # One call_later per batch marks it due; run() never waits with a
+        # timeout, which would arm and cancel a timer for every entry
+        self.timer = None
+        self.due = False
+        self.max_in_flight = max_in_flight
+        self.seq = 0
+        # seq -> (event, payload), oldest first
+        self.unacked = {}
+        self.window_sid = None
+        self.acked = asyncio.Event()
+
+    async def put(self, stream_type, lines):
+        await self.queue.put((stream_type, lines))
+
+    async def close(self):
+        await self.queue.put(None)
+
+    def _on_timer(self):
+        self.timer = None
+        self.due = True
+        if self.queue.empty():
+            # Wake run(); otherwise it sees `due` after its next entry
+            self.queue.put_nowait(_FLUSH)
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.due = False
+        items, self.items = self.items, []
+        max_items, max_chars = self.max_items, self.max_chars
+        batch = []
+        size = 0
+        for item in items:
+            output = item["output"]
+            if len(output) > max_chars:
+                # Only output without newlines gets this long. It is decoded
+                # text already, so it can be cut anywhere
+                pieces = [
+                    {"output": output[start : start + max_chars], "type": item["type"]}
+                    for start in range(0, len(output), max_chars)
+                ]
+            else:
+                pieces = (item,)
+            for piece in pieces:
+                length = len(piece["output"])
+                if batch and (len(batch) >= max_items or size + length > max_chars):
+                    if not await self._emit(batch):
+                        return
+                    batch = []
+                    size = 0
+                batch.append(piece)
+                size += length
+        if batch:
+            await self._emit(batch)
+
+    async def _emit(self, items):
+        # False once the client is gone for good
+        sid = await self._wait_for_window()
+        if sid is None:
+            # room=None would broadcast to everyone
+            return False
+        await self._send(
+            sid,
+            "command_output_batch",
+            {
+                "items": items,
+                "session_id": self.session.session_id,
+                "process_id": self.process_id,
+            },
+        )
+        return True
+
+    async def send_exit(self, exit_code):
+        """Reports the exit after all output, then waits until the client has
+        acked everything or is gone for good."""
+        sid = await self._wait_for_window()
+        if sid is None:
+            return
+        await self._send(
+            sid,
+            "command_exit",
+            {
+                "exit_code": exit_code,
+                "session_id": self.session.session_id,
+                "process_id": self.process_id,
+            },
+        )
+        while self.unacked:
+            if await self._resume() is None:
+                return
+            await self._wait_for_ack()
+
+    async def _send(self, sid, event, payload):
+        payload["seq"] = seq = self.seq
+        self.seq += 1
+        self.unacked[seq] = (event, payload)
+        await sio.emit(event, payload, room=sid, callback=partial(self._on_ack, seq))
+
+    def _on_ack(self, seq, *args):
+        self.unacked.pop(seq, None)
+        self.acked.set()
+
+    async def _resume(self):
+        # The sid to emit to, or None once the client is gone for good. Acks
+        # only come back on the socket an event went out on, so a new socket
+        # gets everything still unacked again first
+        sid = await self.session.wait_for_client()
+        if sid is not None and sid != self.window_sid:
+            self.window_sid = sid
+            for seq, (event, payload) in list(self.unacked.items()):
+                await sio.emit(
+                    event, payload, room=sid, callback=partial(self._on_ack, seq)
+                )
+        return sid
+
+    async def _wait_for_window(self):
+        while True:
+            sid = await self._resume()
+            if sid is None or len(self.unacked) < self.max_in_flight:
+                return sid
+            await self._wait_for_ack()
+
+    async def _wait_for_ack(self):
+        # Times out every second, so a socket that dropped (and whose acks
+        # never come) is noticed and its events re-sent
+        self.acked.clear()
+        try:
+            await asyncio.wait_for(self.acked.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            entry = await self.queue.get()
+            if entry is None:
+                break
+            if entry is not _FLUSH:
+                stream_type, lines = entry
+                self.items.extend(
+                    {"output": line, "type": stream_type} for line in lines
+                )
+                if self.timer is None and not self.due:
+                    self.timer = loop.call_later(self.max_delay, self._on_timer)
+            if self.due or len(self.items) >= self.max_lines:
+                await self.flush()
+        # Emit whatever is left before the caller reports the exit
+        await self.flush()
+
+
+async def run_once(command, cwd=None, timeout=None):
+    """Runs a command in a fresh shell. Same contract as Shell.run."""
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd,
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise
+    return stdout, stderr, process.returncode
+
+
+async def create_session(session_id: str, path: Optional[str]):
+    session_manager.create_session(session_id, path or "/default/path")
+    if PERSISTENT_SHELL:
+        # Pay for the bash startup here rather than on the first command
+        await session_manager.get_session(session_id).shell.start()
+
+
 @app.post("/initialize")
-async def initialize(init_data: InitType):
+async def initialize(request: Request):
+    init_data = await decode_body(request, init_decoder)
     print(f"Initializing session with data: {init_data}")
     session_id = init_data.session_id
-    session_path = init_data.path or "/default/path"
-    session_manager.create_session(session_id, session_path)
-    return InitResponse(session_id=session_id)
+    await create_session(session_id, init_data.path)
+    return Response(
+        msgspec.json.encode(InitResponse(session_id=session_id)),
+        media_type="application/json",
+    )
 
 
 @app.post("/run_command")
-async def run_command(data: dict):
-    session_id = data.get("session_id")
-    command = data.get("command")
-    path = data.get("path")
-    mode = data.get("mode", ExecutionMode.WAIT)
-    timeout = data.get("timeout", 10)
+async def run_command(request: Request):
+    data = await decode_body(request, run_command_decoder)
+    session_id = data.session_id
+    command = data.command
+    path = data.path
+    mode = data.mode
+    timeout = data.timeout
 
     session = session_manager.get_session(session_id)
     if not session:
@@ -209,35 +707,42 @@ async def run_command(data: dict):
         process = await asyncio.create_subprocess_shell(
             command,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+            stderr=(
+                asyncio.subprocess.STDOUT
+                if data.merge_stderr
+                else asyncio.subprocess.PIPE
+            ),
             cwd=path,
         )
         process_obj = Process(process.pid, process, process.stdout, process.stderr)
         session_manager.add_process(session_id, process_obj)
-        return {"process_id": process.pid}
+        # Start streaming right away when the client's socket is known, so it
+        # doesn't need a start_command_stream round trip before output flows
+        streaming = session.sid is not None
+        if streaming:
+            _start_stream(session, process_obj)
+        return {"process_id": process.pid, "streaming": streaming}
 
     elif mode == ExecutionMode.WAIT:
+        # No need to create a Process object for WAIT mode. Commands go through
+        # the session's shell; if it is busy, don't queue behind it.
+        if PERSISTENT_SHELL and not session.shell.busy:
+            run = session.shell.run
+        else:
+            run = run_once
         try:
-            result = subprocess.run(
-                command,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=timeout,
-                cwd=path,
-            )
-            # No need to create a Process object for WAIT mode
-            return {
-                "stdout": result.stdout,
-                "stderr": result.stderr,
-                "exit_code": result.returncode,
-                "finished": result.returncode == 0,
-            }
-        except subprocess.TimeoutExpired:
+            stdout, stderr, exit_code = await run(command, path, timeout)
+        except asyncio.TimeoutError:
             return {
                 "error": "Command timed out",
                 "finished": False,
             }
+        return {
+            "stdout": stdout.decode(errors="replace"),
+            "stderr": stderr.decode(errors="replace"),
+            "exit_code": exit_code,
+            "finished": exit_code == 0,
+        }
 
     elif mode == ExecutionMode.BACKGROUND:
         process = await asyncio.create_subprocess_shell(
@@ -251,68 +756,125 @@ async def run_command(data: dict):
         return {"process_id": process.pid}
 
 
-@sio.on("start_command_stream")
-async def start_command_stream(sid, data):
-    session_id = data.get("session_id")
-    process_id = data.get("process_id")
+def _start_stream(session, process):
+    """Starts forwarding a process's output to the session's client.
 
-    session = session_manager.get_session(session_id)
-    if not session:
-        raise HTTPException(status_code=400, detail="Session not found")
+    Safe to call more than once: a process is only ever streamed by one task.
+    """
+    if process.streaming:
+        return
+    process.streaming = True
+    session_id = session.session_id
+    process_id = process.pid
 
-    process: Process = session.get_process(process_id)
-    if not process:
-        raise HTTPException(status_code=404, detail="Process not found")
+    batcher = OutputBatcher(session, process_id)
 
     async def stream_output():
         try:
 
-            async def read_stream(stream, stream_type):
-                while True:
-                    line = await stream.readline()
-                    if line:
-                        await sio.emit(
-                            "command_output",
-                            {
-                                "output": line.decode(),
-                                "type": stream_type,
-                                "session_id": session_id,
-                                "process_id": process_id,
-                            },
-                            room=session.sid,
+            async def read_streams():
+                flusher = asyncio.create_task(batcher.run())
+                stream_types = {process._stdout: "stdout"}
+                # No stderr pipe when the command was started with merge_stderr
+                if process._stderr is not None:
+                    stream_types[process._stderr] = "stderr"
+                # Each chunk is decoded once; the incremental decoder carries a
+                # multi-byte character split across reads over to the next one
+                decoders = {
+                    stream: codecs.getincrementaldecoder("utf-8")(errors="replace")
+                    for stream in stream_types
+                }
+                tails = dict.fromkeys(stream_types, "")
+                # One loop serves both pipes: keep a read pending on each and
+                # handle whichever completes first. Reading whatever the pipe
+                # holds and splitting lines here avoids a wakeup per line
+                reads = {
+                    asyncio.ensure_future(stream.read(STREAM_READ_SIZE)): stream
+                    for stream in stream_types
+                }
+                try:
+                    while reads:
+                        done, _ = await asyncio.wait(
+                            reads, return_when=asyncio.FIRST_COMPLETED
                         )
-                    else:
-                        break
-
-            await asyncio.gather(
-                read_stream(process._stdout, "stdout"),
-                read_stream(process._stderr, "stderr"),
-            )
-
+                        for read in done:
+                            stream = reads.pop(read)
+                            chunk = read.result()
+                            stream_type = stream_types[stream]
+                            text = tails[stream] + decoders[stream].decode(
+                                chunk, final=not chunk
+                            )
+                            if not chunk:
+                                if text:
+                                    await batcher.put(stream_type, [text])
+                                continue
+                            end = text.rfind("\n") + 1
+                            tails[stream] = text[end:]
+                            if end:
+                                await batcher.put(
+                                    stream_type, text[:end].splitlines(keepends=True)
+                                )
+                            if len(tails[stream]) >= STREAM_READ_SIZE:
+                                # Send a long partial line in pieces rather
+                                # than re-copying it on every read until its
+                                # newline (or EOF) arrives
+                                await batcher.put(stream_type, [tails[stream]])
+                                tails[stream] = ""
+                            read =asyncio.ensure_future(stream.read(STREAM_READ_SIZE))
+                            reads[read] = stream
+                finally:
+                    for read in reads:
+                        read.cancel()
+                    await batcher.close()
+                    await flusher
+
+            # Cap concurrent streamers per session; extra streams wait here
+            # (their commands block on full pipes) until a slot frees up
+            async with session.stream_slots:
+                await read_streams()
+
+        except asyncio.CancelledError:
+            # Nobody is listening anymore, so stop the command as well
+            if process.returncode is None:
+                process.terminate()
+            raise
         except Exception as e:
             print(f"Error during streaming: {e}")
         finally:
             await process.wait()  # Ensure the process is waited on
             process.exit_code = process.process.returncode
             session_manager.remove_process(session_id, process)
-            await sio.emit(
-                "command_exit",
-                {
-                    "exit_code": process.exit_code,
-                    "session_id": session_id,
-                    "process_id": process_id,
-                },
-                room=session.sid,
-            )
+            await batcher.send_exit(process.exit_code)
 
-    asyncio.create_task(stream_output())
+    session.add_task(asyncio.create_task(stream_output()))
 
 
-@app.post("/kill_command")
-async def kill_command(data: dict):
+@sio.on("start_command_stream")
+async def start_command_stream(sid, data):
     session_id = data.get("session_id")
     process_id = data.get("process_id")
 
+    # Socket.IO handlers have no HTTP response to carry an HTTPException,
+    # so failures are reported to the caller as a command_error event
+    session = session_manager.get_session(session_id)
+    if not session:
+        await sio.emit("command_error", {"error": "Session not found"}, room=sid)
+        return
+
+    process: Process = session.get_process(process_id)
+    if not process:
+        await sio.emit("command_error", {"error": "Process not found"}, room=sid)
+        return
+
+    _start_stream(session, process)
+
+
+@app.post("/kill_command")
+async def kill_command(request: Request):
+    data = await decode_body(request, kill_command_decoder)
+    session_id = data.session_id
+    process_id = data.process_id
+
     session = session_manager.get_session(session_id)
     if not session:
         raise HTTPException(status_code=400, detail="Session not found")
@@ -339,7 +901,16 @@ async def connect(sid, environ):
 async def sio_initialize(sid, data):
     session_id = data.get("session_id")
     if not session_id:
-        raise HTTPException(status_code=400, detail="Session ID is required")
+        await sio.emit(
+            "command_error", {"error": "Session ID is required"}, room=sid
+        )
+        return
+
+    # With a path the session is created here too, sparing the client the
+    # separate POST /initialize round-trip
+    if "path" in data:
+        print(f"Initializing session with data: {data}")
+        await create_session(session_id, data["path"])
 
     session_manager.set_session_sid(session_id, sid)
 
@@ -351,21 +922,30 @@ async def sio_initialize(sid, data):
 @sio.on("check_status")
 async def check_status(sid, data):
     process_id = data.get("process_id")
+    # Echoed back so the client can match the reply to its request
+    req_id = data.get("req_id")
     session = session_manager.get_session_by_sid(sid)
 
     if session:
         process = session.get_process(process_id)
         running = process and process.returncode is None
         await sio.emit(
-            "status", {"running": running, "session_id": session.session_id}, room=sid
+            "status",
+            {"running": running, "session_id": session.session_id, "req_id": req_id},
+            room=sid,
         )
     else:
-        await sio.emit("status", {"running": False, "session_id": None}, room=sid)
+        await sio.emit(
+            "status", {"running": False, "session_id": None, "req_id": req_id}, room=sid
+        )
 
 
 @sio.on("disconnect")
 async def disconnect(sid):
     print(f"Client {sid} disconnected")
+    # The session's streams keep running for DISCONNECT_GRACE seconds, so a
+    # reconnecting client can re-initialize and pick them up again
+    session_manager.clear_sid(sid)
 
 
 @app.get("/")
@@ -378,16 +958,84 @@ async def read_item(item_id: int):
     return {"item_id": item_id}
 
 
+# Blocking filesystem helpers, run off the event loop (asyncio.to_thread or
+# StreamingResponse's threadpool) so large files and trees don't stall it.
+def _open_for_write(full_path, make_dirs=False, mode="w"):
+    if make_dirs:
+        parent_dir = os.path.dirname(full_path)  # Get the parent directory
+        os.makedirs(parent_dir, exist_ok=True)  # Create directories for the parent
+    return open(full_path, mode)
+
+
+def _write_file(full_path, content, make_dirs=False):
+    with _open_for_write(full_path, make_dirs) as f:
+        f.write(content)
+
+
+@lru_cache(maxsize=8192)
+def _safe_join(base, file_path):
+    # Purely lexical, so results are safe to cache. Rejects absolute paths
+    # and ".." components that would escape the session directory
+    base = os.path.normpath(base)
+    full_path = os.path.normpath(os.path.join(base, file_path))
+    if os.path.commonpath([base, full_path]) != base:
+        raise HTTPException(status_code=400, detail="Invalid file path")
+    return full_path
+
+
+def _iter_files(root_path):
+    # os.scandir exposes d_type, so most entries need no extra stat() call.
+    # Every entry.path starts with root_path plus a separator, so slicing
+    # that off gives the relative path without os.path.relpath's
+    # normalisation work per file
+    prefix_length = len(os.path.join(root_path, ""))
+    stack = [root_path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            stack.append(entry.path)
+                    else:
+                        yield entry.path[prefix_length:]
+        except OSError:
+            continue
+
+
+@lru_cache(maxsize=256)
+def _compile_filters(regexes):
+    # Compile the filters once into a single alternation instead of running
+    # every regex separately against every path. Clients tend to repeat the
+    # same filter set, so the compiled pattern is kept per tuple of regexes
+    return re.compile("|".join(f"(?:{regex})" for regex in regexes))
+
+
+def _generate_file_paths(root_path, pattern=None, batch_size=1024):
+    # Yield newline-delimited JSON in batches; StreamingResponse pulls each
+    # batch through the threadpool, so batching keeps the hops infrequent
+    batch = []
+    for relative_path in _iter_files(root_path):
+        if pattern is None or pattern.search(relative_path):
+            batch.append(json.dumps(relative_path))
+            if len(batch) >= batch_size:
+                yield "\n".join(batch) + "\n"
+                batch = []
+    if batch:
+        yield "\n".join(batch) + "\n"
+
+
 @app.get("/get_file")
 async def get_file(session_id: str, file_path: str):
     session = session_manager.get_session(session_id)
     if not session:
         raise HTTPException(status_code=400, detail="Session not found")
 
-    print(f"Getting file {file_path} from session {session_id}")
-    print(f"{session.path}")
-    full_path = os.path.join(session.path, file_path)
-    if not os.path.isfile(full_path):
+    logger.debug(
+        "Getting file {} from session {} ({})", file_path, session_id, session.path
+    )
+    full_path = _safe_join(session.path, file_path)
+    if not await asyncio.to_thread(os.path.isfile, full_path):
         raise HTTPException(status_code=404, detail="File not found")
 
     return FileResponse(full_path)
@@ -395,53 +1043,71 @@ async def get_file(session_id: str, file_path: str):
 
 @app.post("/write_file")
 async def write_file(request: Request):
-    data = await request.json()
-    session_id = data.get("session_id")
-    file_path = data.get("file_path")
-    content = data.get("content")
-    make_dirs = data.get("make_dirs", False)
+    data = await decode_body(request, write_file_decoder)
+    session_id = data.session_id
+    file_path = data.file_path
+    content = data.content
+    make_dirs = data.make_dirs
 
     session = session_manager.get_session(session_id)
     if not session:
         raise HTTPException(status_code=400, detail="Session not found")
 
-    full_path = os.path.join(session.path, file_path)
-    if make_dirs:
-        parent_dir = os.path.dirname(full_path)  # Get the parent directory
-        os.makedirs(parent_dir, exist_ok=True)  # Create directories for the parent
-    with open(full_path, "w") as f:
-        f.write(content)
+    full_path = _safe_join(session.path, file_path)
+    await asyncio.to_thread(_write_file, full_path, content, make_dirs)
+
+    return {"status": "success"}
+
+
+@app.post("/upload_file")
+async def upload_file(
+    request: Request, session_id: str, file_path: str, make_dirs: bool = False
+):
+    # The body is the raw file content, written as it arrives rather than
+    # decoded from a JSON envelope; everything else is in the query string
+    session = session_manager.get_session(session_id)
+    if not session:
+        raise HTTPException(status_code=400, detail="Session not found")
+
+    full_path = _safe_join(session.path, file_path)
+    f = await asyncio.to_thread(_open_for_write, full_path, make_dirs, "wb")
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await asyncio.to_thread(f.write, chunk)
+    finally:
+        await asyncio.to_thread(f.close)
 
     return {"status": "success"}
 
 
 @app.post("/make_dirs")
 async def make_dirs(request: Request):
-    data = await request.json()
-    session_id = data.get("session_id")
-    file_path = data.get("file_path")
+    data = await decode_body(request, file_path_decoder)
+    session_id = data.session_id
+    file_path = data.file_path
 
     session = session_manager.get_session(session_id)
     if not session:
         raise HTTPException(status_code=400, detail="Session not found")
 
-    full_path = os.path.join(session.path, file_path)
-    os.makedirs(full_path, exist_ok=True)
+    full_path = _safe_join(session.path, file_path)
+    await asyncio.to_thread(os.makedirs, full_path, exist_ok=True)
     return {"status": "success"}
 
 
 @app.post("/delete_file")
 async def delete_file(request: Request):
-    data = await request.json()
-    session_id = data.get("session_id")
-    file_path = data.get("file_path")
+    data = await decode_body(request, file_path_decoder)
+    session_id = data.session_id
+    file_path = data.file_path
 
     session = session_manager.get_session(session_id)
     if not session:
         raise HTTPException(status_code=400, detail="Session not found")
 
-    full_path = os.path.join(session.path, file_path)
-    os.remove(full_path)
+    full_path = _safe_join(session.path, file_path)
+    await asyncio.to_thread(os.remove, full_path)
     return {"status": "success"}
 
 
@@ -451,25 +1117,28 @@ async def file_exists(session_id: str, file_path: str):
     if not session:
         raise HTTPException(status_code=400, detail="Session not found")
 
-    full_path = os.path.join(session.path, file_path)
-    exists = os.path.exists(full_path)
+    full_path = _safe_join(session.path, file_path)
+    exists = await asyncio.to_thread(os.path.exists, full_path)
     return {"exists": exists}
 
 
 @app.get("/get_all_file_paths")
-async def get_all_file_paths(session_id: str, regexes: List[str] = []):
+async def get_all_file_paths(session_id: str, regexes: List[str] = Query([])):
     session = session_manager.get_session(session_id)
     if not session:
         raise HTTPException(status_code=400, detail="Session not found")
 
-    file_paths = []
-    for root, _, files in os.walk(session.path):
-        for file in files:
-            relative_path = os.path.relpath(os.path.join(root, file), session.path)
-            if not regexes or any(re.search(regex, relative_path) for regex in regexes):
-                file_paths.append(relative_path)
+    pattern = None
+    if regexes:
+        try:
+            pattern = _compile_filters(tuple(regexes))
+        except re.error as e:
+            raise HTTPException(status_code=400, detail=f"Invalid regex: {e}")
 
-    return file_paths
+    return StreamingResponse(
+        _generate_file_paths(session.path, pattern),
+        media_type="application/x-ndjson",
+    )
 
 
 @app.get("/read_file")
@@ -478,14 +1147,10 @@ async def read_file(session_id: str, file_path: str):
     if not session:
         raise HTTPException(status_code=400, detail="Session not found")
 
-    print(f"Reading file {file_path} from session {session_id}")
-    full_path = os.path.join(session.path, file_path)
-    if not os.path.isfile(full_path):
+    logger.debug("Reading file {} from session {}", file_path, session_id)
+    full_path = _safe_join(session.path, file_path)
+    if not await asyncio.to_thread(os.path.isfile, full_path):
         raise HTTPException(status_code=404, detail="File not found")
 
-    try:
-        with open(full_path, "r") as file:
-            content = file.read()
-        return {"content": content}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error reading file: {str(e)}")
+    # Sent straight from disk instead of being loaded and wrapped in JSON
+    return FileResponse(full_path, media_type="text/plain")
@@ -11,12 +11,28 @@ from ._client import (
     StreamProcess,
 )
 
-from ._manager import (
-    Kubebox,
-    KubeboxPod,
-    KubeboxService,
-    KubeboxPodExistsError,
-)
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from ._manager import (
+        Kubebox,
+        KubeboxPod,
+        KubeboxService,
+        KubeboxPodExistsError,
+    )
+
+# The manager pulls in the kubernetes client, which takes longer to import
+# than everything else here combined; load it on first use so scripts that
+# only talk to a sandbox don't pay for it
+_MANAGER_EXPORTS = {"Kubebox", "KubeboxPod", "KubeboxService", "KubeboxPodExistsError"}
+
+
+def __getattr__(name):
+    if name in _MANAGER_EXPORTS:
+        from . import _manager
+
+        return getattr(_manager, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 __all__ = [
     "SandboxClient",
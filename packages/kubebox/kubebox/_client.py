@@ -8,13 +8,34 @@ Todo:
 1. Make it stream stderr too...
 """
 
+import functools
+import itertools
+import logging
+import sys
+import uuid
 import socketio
 import asyncio
 import aiohttp
-from pydantic import BaseModel
-from typing import Literal, Optional, AsyncIterator, Union
+import yarl
+import msgspec
+import orjson
+from typing import Callable, Literal, Optional, AsyncIterable, AsyncIterator, TextIO, Type, Union
 from enum import Enum
 
+logger = logging.getLogger(__name__)
+
+# Per-stream limit on outputs received but not yet consumed
+STREAM_QUEUE_SIZE = 1024
+# Sent with bodies that are already orjson-encoded bytes
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+async def _raise_status(response: aiohttp.ClientResponse, error: str):
+    # Read the (small) error body first: aiohttp only puts a connection back
+    # in the pool once its response has been consumed, and closes it otherwise
+    await response.read()
+    raise Exception(f"{error}: {response.status}")
+
 
 class CommandMode(str, Enum):
     STREAM = "stream"
@@ -22,297 +43,731 @@ class CommandMode(str, Enum):
     BACKGROUND = "background"
 
 
-class CommandOutput(BaseModel):
+# Built once per streamed line, so these are msgspec Structs rather than
+# pydantic models: construction is a C-level slot fill with no validation.
+# They only ever hold str/int fields, so gc=False keeps them out of the
+# cyclic GC's tracked set (and its collections) during output storms
+class CommandOutput(msgspec.Struct, frozen=True, gc=False):
     output: str
     type: Literal["stdout", "stderr"]
     process_id: Union[str, int]
 
 
-class CommandExit(BaseModel):
+class CommandExit(msgspec.Struct, frozen=True, gc=False):
     exit_code: int
     process_id: Union[str, int]
 
 
-class CommandResult(BaseModel):
-    stdout: str | None = None
-    stderr: str | None = None
-    exit_code: int | None = None
+# The replies below are rarer, but decoding them into Structs too keeps
+# pydantic off the client entirely; kw_only matches pydantic's keyword-only
+# constructors, and unknown reply fields are ignored as before
+class CommandResult(msgspec.Struct, kw_only=True):
+    stdout: Optional[str] = None
+    stderr: Optional[str] = None
+    exit_code: Optional[int] = None
     finished: bool
 
 
-class Status(BaseModel):
-    running: bool | None
+class Status(msgspec.Struct):
+    running: Optional[bool]
 
 
-class CommandKilled(BaseModel):
-    status: str
+class CommandKilled(msgspec.Struct):
+    # The sandbox answers an unknown process with an error body instead
+    status: str = "not found"
     exit_code: Optional[int] = None
 
 
-class CommandError(BaseModel):
+class CommandError(msgspec.Struct):
     error: str
 
 
-class BackgroundProcess(BaseModel):
+class BackgroundProcess(msgspec.Struct):
     process_id: Union[str, int]
 
 
+# run_command's dispatch to the mode-specific SandboxClient methods. Keyed
+# by the str-valued enum, so plain "wait" etc. look up the same entries
+_RUN_COMMAND_METHODS = {
+    CommandMode.STREAM: "stream_command",
+    CommandMode.WAIT: "wait_command",
+    CommandMode.BACKGROUND: "background_command",
+}
+
+
+class StreamBuffer:
+    """Hands a stream's outputs from the Socket.IO handlers to its reader.
+
+    Writers append whole events to the active list; the reader swaps it for
+    an empty spare and iterates the full one, so a reader that keeps up
+    wakes once per event instead of once per line. Writers wait once
+    `maxsize` outputs are pending, and a lock keeps waiting writers (each
+    Socket.IO handler runs in its own task) in arrival order. A waiting
+    handler hasn't returned, so its event isn't acked yet; that ack is what
+    the sandbox's send window waits on. `seq` is the next event sequence
+    number expected, so events re-sent after a reconnect are only taken once.
+    """
+
+    __slots__ = ("items", "spare", "maxsize", "readable", "writable", "lock", "seq")
+
+    def __init__(self, maxsize: int = STREAM_QUEUE_SIZE):
+        self.items: list = []
+        self.spare: list = []
+        self.maxsize = maxsize
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.seq = 0
+
+    async def put(self, outputs: list):
+        async with self.lock:
+            while len(self.items) >= self.maxsize:
+                self.writable.clear()
+                await self.writable.wait()
+            self.items.extend(outputs)
+            self.readable.set()
+
+    async def get_batch(self) -> list:
+        while not self.items:
+            self.readable.clear()
+            await self.readable.wait()
+        batch, self.items, self.spare = self.items, self.spare, []
+        self.writable.set()
+        return batch
+
+    def recycle(self, batch: list):
+        # Hand a drained list back so the next swap doesn't allocate
+        batch.clear()
+        self.spare = batch
+
+
 class StreamProcess:
-    def __init__(self, process_id: int, stream_queue: asyncio.Queue):
+    """Async iterator over a streamed command's outputs, ending with its exit."""
+
+    def __init__(
+        self,
+        process_id: int,
+        stream_buffer: StreamBuffer,
+        on_done: Optional[Callable[[], None]] = None,
+    ):
         self.process_id = process_id
-        self.stream_queue = stream_queue
+        self.stream_buffer = stream_buffer
+        self._on_done = on_done
+        self._batch: list = []
+        self._index = 0
+        self._done = False
+
+    def stream(self) -> "StreamProcess":
+        # Kept for callers that iterate `process.stream()`
+        return self
 
-    async def stream(self) -> AsyncIterator[CommandOutput | CommandExit]:
-        while True:
-            output = await self.stream_queue.get()
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Union[CommandOutput, CommandExit]:
+        if self._done:
+            raise StopAsyncIteration
+        batch, index = self._batch, self._index
+        if index >= len(batch):
+            if batch:
+                self.stream_buffer.recycle(batch)
+            batch = self._batch = await self.stream_buffer.get_batch()
+            index = 0
+        elif not index & 63:
+            # Outputs from a batch in hand return without suspending, so a
+            # long batch would run to the end without letting other tasks in
+            await asyncio.sleep(0)
+        output = batch[index]
+        self._index = index + 1
+        if isinstance(output, CommandExit):
+            self._finish()
+        return output
+
+    def _finish(self):
+        self._done = True
+        if self._on_done is not None:
+            self._on_done()
+
+    async def echo(self, file: Optional[TextIO] = None) -> Optional[CommandExit]:
+        """Writes the output to `file` (stdout by default) until the command
+        exits, and returns its exit.
+
+        One write per buffered run of output instead of a print per line, so
+        a chatty command doesn't stall the event loop on terminal writes.
+        """
+        if file is None:
+            file = sys.stdout
+        exit_info = None
+        async for output in self.coalesced():
             if isinstance(output, CommandExit):
+                exit_info = output
+            else:
+                file.write(output.output)
+        file.flush()
+        return exit_info
+
+    async def coalesced(self) -> AsyncIterator[Union[CommandOutput, CommandExit]]:
+        """Like iterating the process, but joins each run of same-type
+        outputs already buffered into one CommandOutput.
+
+        For consumers that don't need output line by line: a burst of
+        thousands of lines arrives as a few strings instead.
+        """
+        while not self._done:
+            batch, index = self._batch, self._index
+            if index >= len(batch):
+                if batch:
+                    self.stream_buffer.recycle(batch)
+                batch = self._batch = await self.stream_buffer.get_batch()
+                index = 0
+
+            merged = []
+            chunks = []
+            kind = None
+            for output in itertools.islice(batch, index, None):
+                index += 1
+                if isinstance(output, CommandExit) or output.type != kind:
+                    if chunks:
+                        merged.append(
+                            CommandOutput(
+                                output="".join(chunks),
+                                type=kind,
+                                process_id=self.process_id,
+                            )
+                        )
+                        chunks = []
+                    if isinstance(output, CommandExit):
+                        merged.append(output)
+                        self._finish()
+                        break
+                    kind = output.type
+                chunks.append(output.output)
+            else:
+                if chunks:
+                    merged.append(
+                        CommandOutput(
+                            output="".join(chunks), type=kind, process_id=self.process_id
+                        )
+                    )
+            self._index = index
+
+            for output in merged:
                 yield output
-                break
-            yield output
-            
-    def __aiter__(self):
-        return self.stream()
 
 
 class SandboxClient:
-    def __init__(self, private_key: str, url: str = "http://localhost:80"):
+    # One client is one connection pool. keepalive_timeout must stay below the
+    # sandbox's own keep-alive (uvicorn --timeout-keep-alive, 75s in the image)
+    # so we never reuse a connection the server is about to close.
+    def __init__(
+        self,
+        private_key: str,
+        url: str = "http://localhost:80",
+        pool_maxsize: int = 64,
+        keepalive_timeout: float = 60,
+        connect_timeout: float = 10,
+        stream_buffer_size: int = STREAM_QUEUE_SIZE,
+    ):
         self.private_key = private_key
         self.url = url
-        self.sio = socketio.AsyncClient()
+        self.pool_maxsize = pool_maxsize
+        self.keepalive_timeout = keepalive_timeout
+        self.connect_timeout = connect_timeout
+        # Outputs a stream holds before its handlers wait. Each event gets
+        # its own handler task, so a full buffer doesn't hold up the socket;
+        # it holds back the event's ack, and the sandbox stops emitting a
+        # stream once 8 of its batches are unacked, so a stalled stream holds
+        # at most this many outputs plus those batches. Smaller bounds memory
+        # per stream, larger absorbs bursts
+        self.stream_buffer_size = stream_buffer_size
+        # Must match the sandbox's Socket.IO serializer. A library client
+        # shouldn't take over the host application's Ctrl-C handling
+        self.sio = socketio.AsyncClient(serializer="msgpack", handle_sigint=False)
         self.sessions = {}
-        self.initialized_event = asyncio.Event()
-        self.stream_queues: dict[int, asyncio.Queue] = {}
-        self.result_event = asyncio.Event()
-        self.result_data = None
+        self.stream_buffers: dict[int, StreamBuffer] = {}
+        # initialize_session futures, keyed by session id. Futures are made
+        # per call on the running loop, so the client can be built anywhere
+        self._init_waiters: dict[str, asyncio.Future] = {}
+        self._http: Optional[aiohttp.ClientSession] = None
+        # Endpoint URLs, parsed once instead of on every request
+        self._urls: dict[str, yarl.URL] = {}
+        # check_status futures, keyed by the req_id the sandbox echoes back
+        self._status_waiters: dict[str, asyncio.Future] = {}
 
         # Register event handlers
         self.sio.on("connect", self.on_connect)
         self.sio.on("disconnect", self.on_disconnect)
         self.sio.on("initialized", self.on_initialized)
         self.sio.on("command_output", self.on_command_output)
+        self.sio.on("command_output_batch", self.on_command_output_batch)
         self.sio.on("command_exit", self.on_command_exit)
-        self.sio.on("command_result", self.on_command_result)
         self.sio.on("status", self.on_status)
         self.sio.on("command_killed", self.on_killed)
         self.sio.on("command_error", self.on_error)
 
     async def on_connect(self):
-        print("Connected to the server")
+        logger.info("Connected to the server")
+        # After a reconnect, bind the new socket to our sessions again; the
+        # sandbox holds their streams for a while, so they carry on here
+        for session_id in self.sessions:
+            await self.sio.emit("initialize", {"session_id": session_id})
 
     async def on_disconnect(self):
-        print("Disconnected from the server")
+        logger.info("Disconnected from the server")
 
     async def on_initialized(self, data):
-        print("Initialization response:", data)
-        self.initialized_event.set()
+        logger.debug("Initialization response: %s", data)
+        waiter = self._init_waiters.pop(data.get("session_id"), None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
 
+    # Events come from the sandbox, which already shapes them: output and exit
+    # Structs are built positionally, the lower-rate events via msgspec.convert
     async def on_command_output(self, data):
-        data = CommandOutput(**data)
-        await self.get_stream_queue(data.process_id).put(data)
+        process_id = data["process_id"]
+        await self._put_stream(
+            process_id, [CommandOutput(data["output"], data["type"], process_id)]
+        )
 
-    async def on_command_exit(self, data):
-        exit_info = CommandExit(**data)
-        print(
-            f"Command exited with code {exit_info.exit_code} (Process ID: {exit_info.process_id})"
+    async def on_command_output_batch(self, data):
+        # One event carries many lines, from either stream, in read order
+        stream_buffer = self._take_stream_event(data)
+        if stream_buffer is None:
+            return
+        process_id = data["process_id"]
+        await stream_buffer.put(
+            [
+                CommandOutput(item["output"], item["type"], process_id)
+                for item in data["items"]
+            ]
         )
-        await self.stream_queues[exit_info.process_id].put(exit_info)  # Signal the end of the stream
 
-    async def on_command_result(self, data):
-        self.result_data = CommandResult(**data)
-        self.result_event.set()
+    async def on_command_exit(self, data):
+        stream_buffer = self._take_stream_event(data)
+        if stream_buffer is None:
+            return
+        exit_info = CommandExit(data["exit_code"], data["process_id"])
+        logger.debug(
+            "Command exited with code %s (Process ID: %s)",
+            exit_info.exit_code,
+            exit_info.process_id,
+        )
+        await stream_buffer.put([exit_info])  # Signal the end of the stream
 
     async def on_status(self, data):
-        status = Status(**data)
-        print("Status:", status)
+        waiter = self._status_waiters.pop(data.get("req_id"), None)
+        if waiter is not None:
+            if not waiter.done():
+                waiter.set_result(data)
+            return
+        status = msgspec.convert(data, Status)
+        logger.debug("Status: %s", status)
 
     async def on_killed(self, data):
-        killed_info = CommandKilled(**data)
-        print("Command killed:", killed_info)
+        killed_info = msgspec.convert(data, CommandKilled)
+        logger.info("Command killed: %s", killed_info)
 
     async def on_error(self, data):
-        error_info = CommandError(**data)
-        print("Error:", error_info)
+        error_info = msgspec.convert(data, CommandError)
+        logger.error("Error: %s", error_info)
+
+    def _url(self, path: str) -> yarl.URL:
+        url = self._urls.get(path)
+        if url is None:
+            url = self._urls[path] = yarl.URL(f"{self.url}{path}")
+        return url
+
+    def _get_http(self) -> aiohttp.ClientSession:
+        # One pooled session for every HTTP call, so requests reuse
+        # keep-alive connections instead of reconnecting each time
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_maxsize,
+                    keepalive_timeout=self.keepalive_timeout,
+                    ttl_dns_cache=600,
+                ),
+                # aiohttp's 5 minute total, but an unreachable sandbox fails
+                # after connect_timeout instead of aiohttp's 30s
+                timeout=aiohttp.ClientTimeout(
+                    total=300, sock_connect=self.connect_timeout
+                ),
+            )
+        return self._http
+
+    async def _post_json(
+        self,
+        path: str,
+        body: dict,
+        error: Optional[str] = None,
+        model: Optional[Type[msgspec.Struct]] = None,
+    ):
+        """POSTs a JSON body and returns the decoded JSON reply.
+
+        With `model`, the raw reply is decoded straight into that Struct.
+        With `error`, a non-200 reply raises `error: <status>` instead.
+        """
+        session = self._get_http()
+        async with session.post(
+            self._url(path), data=orjson.dumps(body), headers=JSON_HEADERS
+        ) as response:
+            if error is not None and response.status != 200:
+                await _raise_status(response, error)
+            raw = await response.read()
+        if model is not None:
+            return msgspec.json.decode(raw, type=model)
+        return orjson.loads(raw)
 
     async def connect(self):
+        # Hand engine.io our pooled session so the websocket upgrade shares
+        # the connector (and its DNS cache) with the REST calls. It is set
+        # here rather than in __init__ because a ClientSession needs a
+        # running loop; external_http keeps engine.io from closing it.
+        self.sio.eio.http = self._get_http()
+        self.sio.eio.external_http = True
         await self.sio.connect(self.url, transports=["websocket"])
 
     async def initialize_session(self, session_id: str, path: str):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.url}/initialize",
-                json={"session_id": session_id, "path": path},
-            ) as response:
-                init_response = await response.json()
-                self.sessions[session_id] = init_response["session_id"]
-
-        await self.sio.emit("initialize", {"session_id": session_id})
-        await self.initialized_event.wait()
-
-    def get_stream_queue(self, process_id: int) -> asyncio.Queue:
+        # The sandbox creates the session and binds our socket to it in one
+        # websocket event
+        waiter = asyncio.get_running_loop().create_future()
+        self._init_waiters[session_id] = waiter
+        try:
+            await self.sio.emit("initialize", {"session_id": session_id, "path": path})
+            initialized = await waiter
+        finally:
+            self._init_waiters.pop(session_id, None)
+        self.sessions[session_id] = initialized["session_id"]
+
+    def get_stream_buffer(self, process_id: int) -> StreamBuffer:
         process_id = int(process_id)
-        if process_id not in self.stream_queues:
-            self.stream_queues[process_id] = asyncio.Queue()
-        return self.stream_queues[process_id]
+        stream_buffer = self.stream_buffers.get(process_id)
+        if stream_buffer is None:
+            stream_buffer = self.stream_buffers[process_id] = StreamBuffer(
+                self.stream_buffer_size
+            )
+        return stream_buffer
+
+    def _release_stream_buffer(self, process_id: int, stream_buffer: StreamBuffer):
+        # Once its exit has been read nothing more arrives for the process.
+        # Only drop our own entry, in case the pid was already reused
+        if self.stream_buffers.get(process_id) is stream_buffer:
+            del self.stream_buffers[process_id]
+
+    async def _put_stream(self, process_id, outputs):
+        await self.get_stream_buffer(process_id).put(outputs)
+
+    def _take_stream_event(self, data) -> Optional[StreamBuffer]:
+        # The sandbox re-sends what a dropped socket left unacked, so an event
+        # may arrive twice; returns None for one already taken. Runs before
+        # the handler first awaits, so events are checked in arrival order
+        seq = data["seq"]
+        process_id = int(data["process_id"])
+        stream_buffer = self.stream_buffers.get(process_id)
+        if stream_buffer is None:
+            if seq:
+                # The buffer only goes once its exit was read
+                return None
+            stream_buffer = self.get_stream_buffer(process_id)
+        if seq < stream_buffer.seq:
+            return None
+        stream_buffer.seq = seq + 1
+        return stream_buffer
+
+    async def _post_command(
+        self,
+        session_id: str,
+        command: str,
+        mode: CommandMode,
+        path: Optional[str],
+        timeout: Optional[int],
+        merge_stderr: bool,
+        model: Optional[Type[msgspec.Struct]] = None,
+    ):
+        logger.debug(
+            "Running command: %s, mode: %s, path: %s, timeout: %s",
+            command,
+            mode,
+            path,
+            timeout,
+        )
+        return await self._post_json(
+            "/run_command",
+            {
+                "session_id": session_id,
+                "command": command,
+                "mode": mode,
+                "path": path,
+                "timeout": timeout,
+                "merge_stderr": merge_stderr,
+            },
+            model=model,
+        )
 
-    async def run_command(
+    async def stream_command(
         self,
         session_id: str,
         command: str,
-        mode: CommandMode = CommandMode.STREAM,
         path: Optional[str] = None,
         timeout: Optional[int] = None,
-    ) -> Union[CommandResult, BackgroundProcess, StreamProcess]:
-        print(f"Running command: {command}, mode: {mode}, path: {path}, timeout: {timeout}")
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.url}/run_command",
-                json={
-                    "session_id": session_id,
-                    "command": command,
-                    "mode": mode,
-                    "path": path,
-                    "timeout": timeout,
-                },
-            ) as response:
-                result = await response.json()
-
-        if mode == CommandMode.STREAM:
-            process_id = result["process_id"]
-            stream_queue = self.get_stream_queue(process_id)
+        merge_stderr: bool = False,
+    ) -> StreamProcess:
+        # The reply stays a dict since only the process id is needed
+        result = await self._post_command(
+            session_id, command, CommandMode.STREAM, path, timeout, merge_stderr
+        )
+        process_id = result["process_id"]
+        stream_buffer = self.get_stream_buffer(process_id)
+        # The sandbox starts the stream itself once it knows our socket; it
+        # only needs asking if the socket wasn't bound yet (e.g. reconnecting)
+        if not result.get("streaming"):
             await self.sio.emit(
                 "start_command_stream",
                 {"session_id": session_id, "process_id": process_id},
             )
-            return StreamProcess(process_id, stream_queue)
-        elif mode == CommandMode.WAIT:
-            return CommandResult(**result)
-        elif mode == CommandMode.BACKGROUND:
-            return BackgroundProcess(process_id=result["process_id"])
-
-    async def check_status(self, session_id: str, process_id: str) -> Status:
-        # Create an event to wait for the status response
-        status_event = asyncio.Event()
-        status_data = {}
-
-        async def on_status(data):
-            nonlocal status_data
-            status_data = data
-            status_event.set()
-
-        # Temporarily override the on_status handler
-        self.sio.on("status", on_status)
-
-        # Emit the check_status event with session_id and process_id
-        await self.sio.emit(
-            "check_status", {"session_id": session_id, "process_id": process_id}
+        return StreamProcess(
+            process_id,
+            stream_buffer,
+            functools.partial(
+                self._release_stream_buffer, int(process_id), stream_buffer
+            ),
         )
 
-        # Wait for the status response
-        await status_event.wait()
+    async def wait_command(
+        self,
+        session_id: str,
+        command: str,
+        path: Optional[str] = None,
+        timeout: Optional[int] = None,
+        merge_stderr: bool = False,
+    ) -> CommandResult:
+        return await self._post_command(
+            session_id,
+            command,
+            CommandMode.WAIT,
+            path,
+            timeout,
+            merge_stderr,
+            CommandResult,
+        )
 
-        # Restore the original on_status handler
-        self.sio.on("status", self.on_status)
+    async def background_command(
+        self,
+        session_id: str,
+        command: str,
+        path: Optional[str] = None,
+        timeout: Optional[int] = None,
+        merge_stderr: bool = False,
+    ) -> BackgroundProcess:
+        return await self._post_command(
+            session_id,
+            command,
+            CommandMode.BACKGROUND,
+            path,
+            timeout,
+            merge_stderr,
+            BackgroundProcess,
+        )
 
-        return Status(**status_data)
+    async def run_command(
+        self,
+        session_id: str,
+        command: str,
+        mode: CommandMode = CommandMode.STREAM,
+        path: Optional[str] = None,
+        timeout: Optional[int] = None,
+        merge_stderr: bool = False,
+    ) -> Union[CommandResult, BackgroundProcess, StreamProcess]:
+        """Runs `command` through the `<mode>_command` method for `mode`."""
+        method = _RUN_COMMAND_METHODS.get(mode)
+        if method is None:
+            raise ValueError(f"Unknown command mode: {mode}")
+        return await getattr(self, method)(
+            session_id, command, path, timeout, merge_stderr
+        )
 
-    async def kill_command(self, session_id: str, process_id: str) -> CommandKilled:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.url}/kill_command",
-                json={"session_id": session_id, "process_id": process_id},
-            ) as response:
-                result = await response.json()
+    async def check_status(
+        self, session_id: str, process_id: str, timeout: Optional[float] = 10
+    ) -> Status:
+        # Replies are matched by req_id, so concurrent calls don't mix up.
+        # The timeout covers a reply lost to a dropped connection
+        req_id = uuid.uuid4().hex
+        waiter = asyncio.get_running_loop().create_future()
+        self._status_waiters[req_id] = waiter
+        try:
+            await self.sio.emit(
+                "check_status",
+                {"session_id": session_id, "process_id": process_id, "req_id": req_id},
+            )
+            status_data = await asyncio.wait_for(waiter, timeout)
+        finally:
+            self._status_waiters.pop(req_id, None)
 
-        # Ensure the result includes a status field
-        if "status" not in result:
-            result["status"] = "not found"
+        return msgspec.convert(status_data, Status)
 
-        return CommandKilled(**result)
+    async def kill_command(self, session_id: str, process_id: str) -> CommandKilled:
+        return await self._post_json(
+            "/kill_command",
+            {"session_id": session_id, "process_id": process_id},
+            model=CommandKilled,
+        )
 
     async def disconnect(self):
         await self.sio.disconnect()
         # Ensure all sessions are closed
         await self.sio.eio.disconnect()
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.disconnect()
 
     async def get_file(self, session_id: str, file_path: str) -> str:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.url}/read_file",
-                params={"session_id": session_id, "file_path": file_path},
-            ) as response:
-                if response.status == 200:
-                    return (await response.json())["content"]
-                else:
-                    raise Exception(f"Failed to get file: {response.status}")
+        session = self._get_http()
+        async with session.get(
+            self._url("/read_file"),
+            params={"session_id": session_id, "file_path": file_path},
+        ) as response:
+            if response.status == 200:
+                return await response.text()
+            else:
+                await _raise_status(response, "Failed to get file")
+
+    async def get_file_stream(
+        self, session_id: str, file_path: str, chunk_size: int = 64 * 1024
+    ) -> AsyncIterator[bytes]:
+        """Yields the file's raw bytes as they arrive, without holding it all."""
+        session = self._get_http()
+        async with session.get(
+            self._url("/get_file"),
+            params={"session_id": session_id, "file_path": file_path},
+        ) as response:
+            if response.status != 200:
+                await _raise_status(response, "Failed to get file")
+            async for chunk in response.content.iter_chunked(chunk_size):
+                yield chunk
 
     async def write_file(
         self, session_id: str, file_path: str, content: str, make_dirs: bool = False
     ):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.url}/write_file",
-                json={
-                    "session_id": session_id,
-                    "file_path": file_path,
-                    "content": content,
-                    "make_dirs": make_dirs,
-                },
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    raise Exception(f"Failed to write file: {response.status}")
+        return await self.write_file_stream(
+            session_id, file_path, content.encode(), make_dirs=make_dirs
+        )
+
+    async def write_file_stream(
+        self,
+        session_id: str,
+        file_path: str,
+        content: Union[bytes, AsyncIterable[bytes]],
+        make_dirs: bool = False,
+    ):
+        """Uploads bytes, or an async iterable of chunks, as the raw body."""
+        session = self._get_http()
+        async with session.post(
+            self._url("/upload_file"),
+            params={
+                "session_id": session_id,
+                "file_path": file_path,
+                "make_dirs": "true" if make_dirs else "false",
+            },
+            data=content,
+        ) as response:
+            if response.status == 200:
+                return orjson.loads(await response.read())
+            else:
+                await _raise_status(response, "Failed to write file")
 
     async def make_dirs(self, session_id: str, file_path: str):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.url}/make_dirs",
-                json={"session_id": session_id, "file_path": file_path},
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    raise Exception(f"Failed to make dirs: {response.status}")
+        return await self._post_json(
+            "/make_dirs",
+            {"session_id": session_id, "file_path": file_path},
+            error="Failed to make dirs",
+        )
 
     async def delete_file(self, session_id: str, file_path: str):
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                f"{self.url}/delete_file",
-                json={"session_id": session_id, "file_path": file_path},
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    raise Exception(f"Failed to delete file: {response.status}")
+        return await self._post_json(
+            "/delete_file",
+            {"session_id": session_id, "file_path": file_path},
+            error="Failed to delete file",
+        )
 
     async def file_exists(self, session_id: str, file_path: str) -> bool:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.url}/file_exists",
-                params={"session_id": session_id, "file_path": file_path},
-            ) as response:
-                if response.status == 200:
-                    return await bool(response.json()["exists"])
-                elif response.status == 404:
-                    return False
-                else:
-                    raise Exception(
-                        f"Failed to check if file exists: {response.status}"
-                    )
+        session = self._get_http()
+        async with session.get(
+            self._url("/file_exists"),
+            params={"session_id": session_id, "file_path": file_path},
+        ) as response:
+            if response.status == 200:
+                return bool(orjson.loads(await response.read())["exists"])
+            elif response.status == 404:
+                await response.read()
+                return False
+            else:
+                await _raise_status(response, "Failed to check if file exists")
 
     async def get_all_file_paths(self, session_id: str, regexes: list[str] = []) -> list[str]:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"{self.url}/get_all_file_paths",
-                params={"session_id": session_id, "regexes": regexes},
-            ) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    raise Exception(f"Failed to get file paths: {response.status}")
+        session = self._get_http()
+        async with session.get(
+            self._url("/get_all_file_paths"),
+            params={"session_id": session_id, "regexes": regexes},
+        ) as response:
+            if response.status == 200:
+                # The sandbox streams one JSON-encoded path per line
+                return [
+                    orjson.loads(line)
+                    async for line in response.content
+                    if line.strip()
+                ]
+            else:
+                await _raise_status(response, "Failed to get file paths")
+
+    # Bulk helpers: the requests run concurrently on the shared pool, capped
+    # at its size so they don't queue inside the connector
+
+    async def _gather_limited(self, call, items) -> list:
+        semaphore = asyncio.Semaphore(self.pool_maxsize)
+
+        async def limited(item):
+            async with semaphore:
+                return await call(item)
+
+        return await asyncio.gather(*(limited(item) for item in items))
+
+    async def get_files(self, session_id: str, file_paths: list[str]) -> dict[str, str]:
+        contents = await self._gather_limited(
+            lambda file_path: self.get_file(session_id, file_path), file_paths
+        )
+        return dict(zip(file_paths, contents))
+
+    async def write_files(
+        self, session_id: str, files: dict[str, str], make_dirs: bool = False
+    ):
+        await self._gather_limited(
+            lambda item: self.write_file(session_id, *item, make_dirs=make_dirs),
+            files.items(),
+        )
+
+    async def file_exists_many(
+        self, session_id: str, file_paths: list[str]
+    ) -> dict[str, bool]:
+        exists = await self._gather_limited(
+            lambda file_path: self.file_exists(session_id, file_path), file_paths
+        )
+        return dict(zip(file_paths, exists))
+
+    async def delete_files(self, session_id: str, file_paths: list[str]):
+        await self._gather_limited(
+            lambda file_path: self.delete_file(session_id, file_path), file_paths
+        )
 
 
 if __name__ == "__main__":
+    from ._run import run
 
     async def main():
         client = SandboxClient(url="http://4.156.80.55:80")
@@ -353,8 +808,7 @@ if __name__ == "__main__":
             mode=CommandMode.STREAM,
             path="test_path",
         )
-        async for output in result:
-            print(output.output)
+        await result.echo()
 
         result = await client.run_command(
             "your-session-id-here",
@@ -363,8 +817,7 @@ if __name__ == "__main__":
             path="test_path",
             # timeout=200,
         )
-        async for output in result:
-            print(output.output)
+        await result.echo()
 
         return
 
@@ -374,11 +827,16 @@ if __name__ == "__main__":
         ):
             print("Streamed Output:", output)
 
-        # Run a command in WAIT mode
-        for i in range(10):
-            result = await client.run_command(
-                "your-session-id-here", "echo HELLO WORLD!", mode=CommandMode.WAIT
+        # Run commands in WAIT mode concurrently
+        results = await asyncio.gather(
+            *(
+                client.run_command(
+                    "your-session-id-here", "echo HELLO WORLD!", mode=CommandMode.WAIT
+                )
+                for _ in range(10)
             )
+        )
+        for result in results:
             print("Command Result:", result)
 
         # Run a command in BACKGROUND mode
@@ -419,4 +877,4 @@ if __name__ == "__main__":
         await client.disconnect()
 
     # Run the main function
-    asyncio.run(main())
+    run(main())
@@ -0,0 +1,71 @@
+"""
+Kubeconfig loading for Kubebox.
+
+Both the Terraform state and the parsed kubeconfig are cached, so creating
+several Kubebox instances in one process only does the work once.
+"""
+
+import copy
+import functools
+import os
+from typing import Optional
+
+import orjson
+import yaml
+
+try:
+    import ijson
+except ImportError:  # pip install kubebox[terraform]
+    ijson = None
+
+
+def _find_kube_config(tfstate_file: str) -> Optional[str]:
+    with open(tfstate_file, "rb") as f:
+        if ijson is not None:
+            # Stream the resources so the rest of the state is never built
+            resources = ijson.items(f, "resources.item")
+        else:
+            resources = orjson.loads(f.read()).get("resources", [])
+
+        for resource in resources:
+            if resource.get("type") == "azurerm_kubernetes_cluster":
+                for instance in resource.get("instances", []):
+                    attributes = instance.get("attributes", {})
+                    # Check for 'kube_config_raw' or 'kube_admin_config_raw'
+                    kube_config_raw = attributes.get(
+                        "kube_config_raw"
+                    ) or attributes.get("kube_admin_config_raw")
+                    if kube_config_raw:
+                        return kube_config_raw
+    return None
+
+
+@functools.lru_cache(maxsize=4)
+def _read_terraform(tfstate_file: str, mtime_ns: int) -> str:
+    kube_config = _find_kube_config(tfstate_file)
+    if not kube_config:
+        raise Exception("Failed to find kube_config in terraform state file.")
+    return kube_config
+
+
+def read_kube_config_from_terraform(tfstate_file: str) -> str:
+    """Returns the raw kubeconfig of the cluster in a Terraform state file.
+
+    Cached until the file's modification time changes.
+    """
+    return _read_terraform(tfstate_file, os.stat(tfstate_file).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_kube_config(kube_config: str) -> dict:
+    # libyaml's C parser when PyYAML was built with it
+    return yaml.load(kube_config, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def parse_kube_config(kube_config: str) -> dict:
+    """Parses a kubeconfig YAML string.
+
+    The parse is cached. Each caller gets its own copy, since the kubernetes
+    loader may write into it, e.g. when refreshing OIDC or exec credentials.
+    """
+    return copy.deepcopy(_parse_kube_config(kube_config))
@@ -5,52 +5,352 @@ Limitations:
 """
 
 import base64
+import functools
 import json
 import logging
 import asyncio
+import math
+import random
+import threading
 import time  # Ensure this import is at the top of the file
-from typing import Optional, Tuple  # Added logging package
-from kubernetes import client, config
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Sequence, Tuple, Union  # Added logging package
+from kubernetes import client, config, watch
 from kubernetes.client.rest import ApiException
+import orjson
 import os  # Add this import at the top of the file
 
+from ._config import parse_kube_config, read_kube_config_from_terraform
+
 
 class KubeboxPodExistsError(Exception):
     """Exception raised when a pod already exists."""
 
 
-class KubeboxPod:
-    def __init__(self, name: str, namespace: str, kubebox: "Kubebox" = None):
-        self.name = name
-        self.namespace = namespace
-        self._kubebox = kubebox
+# Upper bound for the backoff when polling instead of watching
+MAX_POLL_INTERVAL = 5.0
+# Watches are renewed after this long, so an abandoned one ends on its own
+MAX_WATCH_SECONDS = 300
+
+
+# Objects are read as plain JSON dicts (_preload_content=False plus _json or
+# _RawWatch): only a few fields are ever looked at, and building the V1Pod /
+# V1Service models costs far more than the request itself
+
+
+def _json(response) -> dict:
+    return orjson.loads(response.data)
+
+
+class _RawWatch(watch.Watch):
+    def unmarshal_event(self, data, return_type):
+        event = orjson.loads(data)
+        event["raw_object"] = event["object"]
+        if event["type"] != "ERROR":
+            # Bookmarks included, so a restarted watch resumes from them
+            self.resource_version = event["object"]["metadata"]["resourceVersion"]
+        return event
+
+
+def _pod_ready(pod: dict) -> bool:
+    status = pod.get("status", {})
+    container_statuses = status.get("containerStatuses")
+    return (
+        status.get("phase") == "Running"
+        and bool(container_statuses)
+        and all(c["ready"] for c in container_statuses)
+    )
+
+
+def _service_address(service: dict) -> Optional[str]:
+    ingress = service.get("status", {}).get("loadBalancer", {}).get("ingress")
+    if ingress:
+        return ingress[0].get("ip") or ingress[0].get("hostname")
+    return None
+
 
-    async def wait_until_ready(self, poll_interval: float = 0.1):
-        start_time = asyncio.get_event_loop().time()
+def _watch_for(w, list_func, name, namespace, check, timeout_seconds):
+    # Blocking; run it in a thread. The first event reports the object as it
+    # is now, so an object that is already there is seen straight away
+    try:
+        for event in w.stream(
+            list_func,
+            namespace=namespace,
+            field_selector=f"metadata.name={name}",
+            timeout_seconds=timeout_seconds,
+        ):
+            if event["type"] != "DELETED":
+                result = check(event["object"])
+                if result:
+                    return result
+    finally:
+        w.stop()
+    return None
+
+
+def _run_in_thread(fn, *args) -> asyncio.Future:
+    """Runs blocking `fn` on a daemon thread of its own and returns a future
+    for its result.
+
+    For watches, which can block for minutes: on the manager's executor they
+    would hold back every other API call queued behind them.
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def run():
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            callback, value = _set_exception, e
+        else:
+            callback, value = _set_result, result
+        try:
+            loop.call_soon_threadsafe(callback, future, value)
+        except RuntimeError:
+            pass  # The loop closed while the watch was running
+
+    threading.Thread(target=run, name="kubebox-watch", daemon=True).start()
+    return future
+
+
+async def _wait_for(
+    call: Callable,
+    read_func,
+    list_func,
+    name: str,
+    namespace: str,
+    check: Callable,
+    timeout: Optional[float] = None,
+    poll_interval: float = 0.1,
+):
+    """Waits until `check` passes for the named object and returns its result.
+
+    Watches the object, so the wait ends as soon as the API server reports
+    the change instead of on the next poll. Falls back to polling `read_func`
+    if watching isn't permitted, starting every `poll_interval` seconds and
+    backing off (with jitter) to MAX_POLL_INTERVAL while the object stays
+    not ready. Raises TimeoutError once `timeout` seconds have passed.
+    Polling reads are made through `call`; the watch runs on its own thread.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    try:
         while True:
+            # Bounded, so the watch is renewed rather than held open forever
+            timeout_seconds = MAX_WATCH_SECONDS
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError
+                timeout_seconds = min(timeout_seconds, max(1, math.ceil(remaining)))
+            w = _RawWatch()
             try:
-                pod = await asyncio.to_thread(
-                    self._kubebox._core_v1.read_namespaced_pod,
-                    name=self.name,
-                    namespace=self.namespace,
+                result = await _run_in_thread(
+                    _watch_for, w, list_func, name, namespace, check, timeout_seconds
                 )
-                status = pod.status
-                if status.phase == "Running":
-                    # Check if containers are ready
-                    all_ready = all([c.ready for c in status.container_statuses])
-                    if all_ready:
-                        elapsed = asyncio.get_event_loop().time() - start_time
-                        logging.info(
-                            f"Pod '{self.name}' is ready. Time taken: {elapsed:.2f} seconds."
+            except asyncio.CancelledError:
+                # Ends the watch at its next event rather than its timeout
+                w.stop()
+                raise
+            if result:
+                return result
+            # The watch ended (server-side timeout); start another one
+    except ApiException as e:
+        if e.status != 403:
+            raise
+        logging.info("Not allowed to watch '%s', polling instead", name)
+
+    delay = poll_interval
+    while deadline is None or loop.time() < deadline:
+        obj = _json(
+            await call(
+                read_func, name=name, namespace=namespace, _preload_content=False
+            )
+        )
+        result = check(obj)
+        if result:
+            return result
+        # Jittered, so many waiters don't poll the API server in lockstep
+        sleep = delay * random.uniform(0.5, 1.5)
+        if deadline is not None:
+            sleep = min(sleep, max(0, deadline - loop.time()))
+        await asyncio.sleep(sleep)
+        delay = min(delay * 1.5, MAX_POLL_INTERVAL)
+    raise TimeoutError
+
+
+@functools.lru_cache(maxsize=128)
+def _ip_peers(ips: Tuple[str, ...]) -> Tuple[dict, ...]:
+    # Shared between calls, so the dicts must not be mutated
+    return tuple({"ipBlock": {"cidr": ip + "/32"}} for ip in ips)
+
+
+@functools.lru_cache(maxsize=128)
+def _service_ports(ports: Tuple[int, ...]) -> Tuple[dict, ...]:
+    # Shared between calls, so the dicts must not be mutated
+    return (
+        {"name": "api", "protocol": "TCP", "port": 80, "targetPort": 80},
+        *(
+            {
+                "name": f"dev-{port}",
+                "protocol": "TCP",
+                "port": port,
+                "targetPort": port,
+            }
+            for port in ports
+        ),
+    )
+
+
+class _Informer:
+    """In-memory mirror of one kind of object in one namespace.
+
+    A daemon thread lists the objects once, then applies watch events to a
+    dict keyed by name, so reads and readiness waits are served from memory
+    instead of hitting the API server. The watch is restarted from a fresh
+    list every `resync_period` seconds (and after 410 Gone), which also
+    reconciles any event that was missed.
+    """
+
+    def __init__(self, list_func, namespace: str, resync_period: int = 60):
+        self.namespace = namespace
+        self._list_func = list_func
+        self._resync_period = resync_period
+        self._items = {}
+        self._waiters = []  # (name, check, loop, future)
+        self._lock = threading.RLock()
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._watch = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._watch is not None:
+            self._watch.stop()
+
+    @property
+    def synced(self) -> bool:
+        return self._synced.is_set()
+
+    def list(self) -> list:
+        with self._lock:
+            return list(self._items.values())
+
+    async def wait_for(self, name: str, check: Callable):
+        """Returns `check(obj)` once it is truthy for the named object."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (name, check, loop, future)
+        with self._lock:
+            obj = self._items.get(name)
+            result = check(obj) if obj is not None else None
+            if result:
+                return result
+            self._waiters.append(waiter)
+        try:
+            return await future
+        finally:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def _update(self, name: str, obj):
+        # Called with the lock held
+        if obj is None:
+            self._items.pop(name, None)
+            return
+        self._items[name] = obj
+        for waiter in self._waiters[:]:
+            waiter_name, check, loop, future = waiter
+            if waiter_name == name:
+                result = check(obj)
+                if result:
+                    self._waiters.remove(waiter)
+                    loop.call_soon_threadsafe(_set_result, future, result)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                listed = _json(
+                    self._list_func(namespace=self.namespace, _preload_content=False)
+                )
+                with self._lock:
+                    names = {obj["metadata"]["name"] for obj in listed["items"]}
+                    for name in set(self._items) - names:
+                        self._update(name, None)
+                    for obj in listed["items"]:
+                        self._update(obj["metadata"]["name"], obj)
+                self._synced.set()
+
+                self._watch = _RawWatch()
+                for event in self._watch.stream(
+                    self._list_func,
+                    namespace=self.namespace,
+                    resource_version=listed["metadata"]["resourceVersion"],
+                    allow_watch_bookmarks=True,
+                    timeout_seconds=self._resync_period,
+                ):
+                    if event["type"] == "BOOKMARK":
+                        continue
+                    obj = event["object"]
+                    with self._lock:
+                        self._update(
+                            obj["metadata"]["name"],
+                            None if event["type"] == "DELETED" else obj,
                         )
-                        return elapsed
             except ApiException as e:
-                logging.error(f"Exception when reading pod status: {e}")
-                break
-            await asyncio.sleep(poll_interval)
+                if e.status != 410:  # 410 Gone: just relist
+                    logging.error("Informer watch failed: %s", e)
+                    self._stopped.wait(1)
+            except Exception as e:
+                logging.error("Informer watch failed: %s", e)
+                self._stopped.wait(1)
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+
+class KubeboxPod:
+    def __init__(self, name: str, namespace: str, kubebox: "Kubebox" = None):
+        self.name = name
+        self.namespace = namespace
+        self._kubebox = kubebox
+
+    async def wait_until_ready(
+        self, poll_interval: float = 0.1, *, timeout: Optional[float] = 600
+    ):
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        await self._kubebox._wait_until(
+            "pod",
+            self.name,
+            self.namespace,
+            _pod_ready,
+            timeout=timeout,
+            poll_interval=poll_interval,
+        )
+        elapsed = loop.time() - start_time
+        logging.info(
+            "Pod '%s' is ready. Time taken: %.2f seconds.",
+            self.name,
+            elapsed,
+        )
+        return elapsed
 
     async def destroy(self):
-        await asyncio.to_thread(
+        await self._kubebox._call(
             self._kubebox._core_v1.delete_namespaced_pod,
             name=self.name,
             namespace=self.namespace,
@@ -71,6 +371,7 @@ class KubeboxService:
 
     async def update_network_policy(self, allowed_ips: list[str]):
         policy_name = f"{self.name}-network-policy"
+        peers = list(_ip_peers(tuple(sorted(set(allowed_ips)))))
         network_policy_manifest = {
             "apiVersion": "networking.k8s.io/v1",
             "kind": "NetworkPolicy",
@@ -78,106 +379,57 @@ class KubeboxService:
             "spec": {
                 "podSelector": {"matchLabels": {"app": self.name}},
                 "policyTypes": ["Ingress", "Egress"],
-                "ingress": [
-                    {
-                        "from": [
-                            {
-                                "ipBlock": {"cidr": f"{allowed_ip}/32"}
-                            }
-                            for allowed_ip in allowed_ips
-                        ]
-                    }
-                ],
-                "egress": [
-                    {
-                        "to": [
-                            {
-                                "ipBlock": {"cidr": f"{allowed_ip}/32"}
-                            }
-                            for allowed_ip in allowed_ips
-                        ]
-                    }
-                ],
+                "ingress": [{"from": peers}],
+                "egress": [{"to": peers}],
             },
         }
 
         try:
-            api_response = await asyncio.to_thread(
-                self._kubebox._networking_v1.replace_namespaced_network_policy,
-                name=policy_name,
-                namespace=self.namespace,
-                body=network_policy_manifest
+            await self._kubebox._apply(
+                "/apis/networking.k8s.io/v1/namespaces/{namespace}/networkpolicies",
+                policy_name,
+                self.namespace,
+                network_policy_manifest,
             )
-            logging.info(f"Network Policy '{policy_name}' updated.")
+            logging.info("Network Policy '%s' applied.", policy_name)
         except ApiException as e:
-            if e.status == 404:
-                try:
-                    api_response = await asyncio.to_thread(
-                        self._kubebox._networking_v1.create_namespaced_network_policy,
-                        namespace=self.namespace,
-                        body=network_policy_manifest
-                    )
-                    logging.info(f"Network Policy '{policy_name}' created.")
-                except ApiException as create_e:
-                    logging.error(f"Exception when creating network policy: {create_e}")
-            else:
-                logging.error(f"Exception when updating network policy: {e}")
-
-    async def wait_until_ready(self, poll_interval: float = 0.1):
-        logging.info(f"Waiting for service '{self.name}' to be ready...")
-        # start_time = asyncio.get_event_loop().time()
-        while True:  # asyncio.get_event_loop().time() - start_time < timeout:
-            try:
-                # Use asyncio.to_thread to run the blocking I/O operation in a separate thread
-                service = await asyncio.to_thread(
-                    self._kubebox._core_v1.read_namespaced_service,
-                    name=self.name,
-                    namespace=self.namespace,
-                )
-                ingress = service.status.load_balancer.ingress
-                if ingress:
-                    ip = ingress[0].ip or ingress[0].hostname
-                    if ip:
-                        logging.info(f"Service '{self.name}' is ready with IP: {ip}.")
-                        return ip
-            except ApiException as e:
-                logging.error(f"Exception when reading service status: {e}")
-                # Consider whether to break or continue based on the type of exception
+            logging.error("Exception when applying network policy: %s", e)
 
-            await asyncio.sleep(poll_interval)
-
-        raise TimeoutError(f"Timed out waiting for service '{self.name}' to be ready.")
+    async def wait_until_ready(
+        self, poll_interval: float = 0.1, *, timeout: Optional[float] = 600
+    ):
+        logging.info("Waiting for service '%s' to be ready...", self.name)
+        ip = await self._kubebox._wait_until(
+            "service",
+            self.name,
+            self.namespace,
+            _service_address,
+            timeout=timeout,
+            poll_interval=poll_interval,
+        )
+        logging.info("Service '%s' is ready with IP: %s.", self.name, ip)
+        return ip
 
     async def get_external_ip(self, timeout: float = 5, poll_interval: float = 0.1):
-        logging.info(f"Waiting for external IP of service '{self.name}'...")
-        start_time = asyncio.get_event_loop().time()
-
-        while asyncio.get_event_loop().time() - start_time < timeout:
-            try:
-                # Use asyncio.to_thread to run the blocking I/O operation in a separate thread
-                service = await asyncio.to_thread(
-                    self._kubebox._core_v1.read_namespaced_service,
-                    name=self.name,
-                    namespace=self.namespace,
-                )
-                ingress = service.status.load_balancer.ingress
-                if ingress:
-                    ip = ingress[0].ip or ingress[0].hostname
-                    if ip:
-                        logging.info(f"Service '{self.name}' is available at {ip}.")
-                        return ip
-            except ApiException as e:
-                logging.error(f"Exception when reading service status: {e}")
-                # Consider whether to break or continue based on the type of exception
-
-            await asyncio.sleep(poll_interval)
-
-        raise TimeoutError(
-            f"Timed out waiting for external IP of service '{self.name}'."
-        )
+        logging.info("Waiting for external IP of service '%s'...", self.name)
+        try:
+            ip = await self._kubebox._wait_until(
+                "service",
+                self.name,
+                self.namespace,
+                _service_address,
+                timeout=timeout,
+                poll_interval=poll_interval,
+            )
+        except TimeoutError:
+            raise TimeoutError(
+                f"Timed out waiting for external IP of service '{self.name}'."
+            )
+        logging.info("Service '%s' is available at %s.", self.name, ip)
+        return ip
 
     async def destroy(self):
-        await asyncio.to_thread(
+        await self._kubebox._call(
             self._kubebox._core_v1.delete_namespaced_service,
             name=self.name,
             namespace=self.namespace,
@@ -191,80 +443,263 @@ class KubeboxService:
 
 
 class Kubebox:
-    def __init__(self, kubebox_str: Optional[str] = None, terraform_path: Optional[str] = None, print_kubebox_str: bool = False):
+    def __init__(self, kubebox_str: Optional[str] = None, terraform_path: Optional[str] = None, print_kubebox_str: bool = False, max_workers: int = 16):
         self.terraform_path = terraform_path
         self._load_kube_config_from_terraform(terraform_path, kubebox_str, print_kubebox_str)
 
-        self._client = client.ApiClient()
-        self._core_v1 = client.CoreV1Api()
+        configuration = client.Configuration.get_default_copy()
+        # One pooled connection per executor thread, plus the watches
+        configuration.connection_pool_maxsize = max_workers + 4
+        self._client = client.ApiClient(configuration)
+        # The Python client can only decode JSON, so ask for it compressed;
+        # urllib3 inflates the body transparently
+        self._client.set_default_header("Accept-Encoding", "gzip")
+        self._core_v1 = client.CoreV1Api(self._client)
+        self._networking_v1 = client.NetworkingV1Api(self._client)
+        # API calls block, so they run on threads owned by the manager, which
+        # also bounds how many requests are in flight at once
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="kubebox-api"
+        )
+        # (kind, namespace) -> _Informer, filled by start_cache
+        self._informers = {}
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    def _api_funcs(self, kind: str):
+        # (read, list) for each kind of object the manager waits on
+        if kind == "pod":
+            return self._core_v1.read_namespaced_pod, self._core_v1.list_namespaced_pod
+        return (
+            self._core_v1.read_namespaced_service,
+            self._core_v1.list_namespaced_service,
+        )
+
+    def start_cache(self, namespace: str = "default", resync_period: int = 60):
+        """Keeps pods and services in `namespace` mirrored in memory.
+
+        Listing and readiness waits in that namespace are then answered from
+        the mirror, updated by one background watch per kind, instead of
+        calling the API server each time. Stop it with `stop_cache`.
+        """
+        for kind in ("pod", "service"):
+            if (kind, namespace) not in self._informers:
+                informer = _Informer(self._api_funcs(kind)[1], namespace, resync_period)
+                self._informers[kind, namespace] = informer
+                informer.start()
+
+    def stop_cache(self):
+        for informer in self._informers.values():
+            informer.stop()
+        self._informers.clear()
+
+    def close(self):
+        """Stops the cache and releases the manager's threads and connections."""
+        self.stop_cache()
+        self._executor.shutdown(wait=False)
+        self._client.rest_client.pool_manager.clear()
+        self._client.close()
+
+    def _cache(self, kind: str, namespace: str) -> Optional[_Informer]:
+        informer = self._informers.get((kind, namespace))
+        if informer is not None and informer.synced:
+            return informer
+        return None
+
+    async def _apply(self, collection: str, name: str, namespace: str, body: dict):
+        # Server-side apply: creates the object or updates the fields kubebox
+        # owns, in one request either way. The generated patch methods can't
+        # send the apply content type, so the request is made directly
+        await self._call(
+            self._client.call_api,
+            collection + "/{name}",
+            "PATCH",
+            path_params={"namespace": namespace, "name": name},
+            query_params=[("fieldManager", "kubebox"), ("force", "true")],
+            header_params={
+                "Accept": "application/json",
+                "Content-Type": "application/apply-patch+yaml",
+            },
+            body=body,
+            auth_settings=["BearerToken"],
+        )
+
+    async def _wait_until(
+        self,
+        kind: str,
+        name: str,
+        namespace: str,
+        check: Callable,
+        timeout: Optional[float] = None,
+        poll_interval: float = 0.1,
+    ):
+        """Returns `check(obj)` once it passes for the named object.
+
+        API errors are logged and retried. Raises TimeoutError after
+        `timeout` seconds; the wait is cancelled then, which also stops the
+        watch behind it.
+        """
+        try:
+            return await asyncio.wait_for(
+                self._wait_until_ready(
+                    kind, name, namespace, check, timeout, poll_interval
+                ),
+                timeout,
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"Timed out waiting for {kind} '{name}'.")
 
-    def create_secret(self, secret_name: str, namespace: str, data: dict[str, str]):
-        # Encode the secret data in base64
-        encoded_data = {k: base64.b64encode(v.encode()).decode() for k, v in data.items()}
+    async def _wait_until_ready(
+        self, kind, name, namespace, check, timeout, poll_interval
+    ):
+        delay = poll_interval
+        while True:
+            try:
+                informer = self._cache(kind, namespace)
+                if informer is not None:
+                    return await informer.wait_for(name, check)
+                read_func, list_func = self._api_funcs(kind)
+                return await _wait_for(
+                    self._call,
+                    read_func,
+                    list_func,
+                    name,
+                    namespace,
+                    check,
+                    timeout,
+                    poll_interval,
+                )
+            except ApiException as e:
+                logging.error("Exception when reading %s status: %s", kind, e)
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 1.5, MAX_POLL_INTERVAL)
+
+    async def create_secret(self, secret_name: str, namespace: str, data: dict[str, Union[str, bytes]]):
+        # Text goes in stringData, which the API server encodes itself; only
+        # binary values need to be base64-encoded here
+        string_data = {k: v for k, v in data.items() if isinstance(v, str)}
+        binary_data = {
+            k: base64.b64encode(v).decode()
+            for k, v in data.items()
+            if not isinstance(v, str)
+        }
 
         secret_manifest = {
             "apiVersion": "v1",
             "kind": "Secret",
             "metadata": {"name": secret_name, "namespace": namespace},
             "type": "Opaque",
-            "data": encoded_data,
+            "stringData": string_data,
         }
+        if binary_data:
+            secret_manifest["data"] = binary_data
 
         try:
-            self._core_v1.create_namespaced_secret(namespace=namespace, body=secret_manifest)
-            logging.info(f"Secret {secret_name} created successfully in namespace {namespace}")
+            await self._call(self._core_v1.create_namespaced_secret, namespace=namespace, body=secret_manifest)
+            logging.info("Secret %s created successfully in namespace %s", secret_name, namespace)
         except ApiException as e:
             if e.status == 409:
-                logging.info(f"Secret {secret_name} already exists in namespace {namespace}")
+                logging.info("Secret %s already exists in namespace %s", secret_name, namespace)
                 try:
-                    self._core_v1.replace_namespaced_secret(namespace=namespace, name=secret_name, body=secret_manifest)
-                    logging.info(f"Secret {secret_name} updated successfully in namespace {namespace}")
+                    patch = {k: secret_manifest[k] for k in ("stringData", "data") if k in secret_manifest}
+                    await self._call(
+                        self._core_v1.patch_namespaced_secret,
+                        namespace=namespace,
+                        name=secret_name,
+                        body=patch,
+                    )
+                    logging.info("Secret %s updated successfully in namespace %s", secret_name, namespace)
                 except ApiException as update_e:
-                    logging.error(f"Error updating secret {secret_name}: {update_e}")
+                    logging.error("Error updating secret %s: %s", secret_name, update_e)
                     raise update_e
             else:
-                logging.error(f"Error creating secret {secret_name}: {e}")
+                logging.error("Error creating secret %s: %s", secret_name, e)
                 raise e
 
-    async def get_all_pods(self, namespace: str = "default") -> list[KubeboxPod]:
-        pods = await asyncio.to_thread(
-            self._core_v1.list_namespaced_pod, namespace=namespace
-        )
+    async def get_all_pods(
+        self,
+        namespace: str = "default",
+        label_selector: Optional[str] = None,
+        field_selector: Optional[str] = None,
+    ) -> list[KubeboxPod]:
+        # The cache holds everything, so filtered lists go to the API server
+        informer = None
+        if label_selector is None and field_selector is None:
+            informer = self._cache("pod", namespace)
+        if informer is not None:
+            pods = informer.list()
+        else:
+            pods = _json(
+                await self._call(
+                    self._core_v1.list_namespaced_pod,
+                    namespace=namespace,
+                    label_selector=label_selector,
+                    field_selector=field_selector,
+                    _preload_content=False,
+                )
+            )["items"]
         return [
-            KubeboxPod(pod.metadata.name, pod.metadata.namespace, kubebox=self)
-            for pod in pods.items
+            KubeboxPod(
+                pod["metadata"]["name"], pod["metadata"]["namespace"], kubebox=self
+            )
+            for pod in pods
         ]
 
     async def get_all_services(
-        self, namespace: str = "default"
+        self,
+        namespace: str = "default",
+        label_selector: Optional[str] = None,
+        field_selector: Optional[str] = None,
     ) -> list[KubeboxService]:
-        services = await asyncio.to_thread(
-            self._core_v1.list_namespaced_service, namespace=namespace
-        )
+        # The cache holds everything, so filtered lists go to the API server
+        informer = None
+        if label_selector is None and field_selector is None:
+            informer = self._cache("service", namespace)
+        if informer is not None:
+            services = informer.list()
+        else:
+            services = _json(
+                await self._call(
+                    self._core_v1.list_namespaced_service,
+                    namespace=namespace,
+                    label_selector=label_selector,
+                    field_selector=field_selector,
+                    _preload_content=False,
+                )
+            )["items"]
         return [
             KubeboxService(
-                service.metadata.name, service.metadata.namespace, kubebox=self
+                service["metadata"]["name"],
+                service["metadata"]["namespace"],
+                kubebox=self,
             )
-            for service in services.items
+            for service in services
         ]
 
-    def create_pod(
+    async def create_pod(
         self,
         pod_name: str,
         namespace: str = "default",
         image: str = "lukejagg/sandbox:latest",
         username: str = None,
-        ports: list[int] = [],
+        ports: Sequence[int] = (),
         kubebox_public_key_secret_name: str = None,
         kubebox_public_key_key: str = None,
     ):
         # The sandbox needs to listen on port 80 for the API. Currently unused as we expose all ports on the Docker image.
         if 80 in ports:
             raise Exception("Port 80 is reserved for the API and cannot be used by the sandbox.")
-        ports = [80] + ports
+        ports = [80, *ports]
         
         logging.info(
-            f"Creating pod: {pod_name} in namespace: {namespace} with image: {image}"
+            "Creating pod: %s in namespace: %s with image: %s",
+            pod_name,
+            namespace,
+            image,
         )
 
         labels = {"app": pod_name}
@@ -300,28 +735,41 @@ class Kubebox:
             ]
 
         try:
-            api_response = self._core_v1.create_namespaced_pod(
-                namespace=namespace, body=pod_manifest
+            await self._apply(
+                "/api/v1/namespaces/{namespace}/pods", pod_name, namespace, pod_manifest
             )
-            logging.info(f"Pod {pod_name} created successfully")
+            logging.info("Pod %s applied successfully", pod_name)
             return KubeboxPod(pod_name, namespace, kubebox=self)
         except ApiException as e:
-            if e.status == 409:
-                logging.info(f"Pod {pod_name} already exists in namespace {namespace}")
-                logging.warning(f"Updating pod metadata currently not supported, please delete and recreate pod with `kubectl delete pod {pod_name} -n {namespace}`")
+            # Most of a pod's spec can't change once it exists, but a new pod
+            # that fails validation is a 422 as well
+            if e.status == 422 and await self._pod_exists(pod_name, namespace):
+                logging.info("Pod %s already exists in namespace %s", pod_name, namespace)
+                logging.warning("Updating pod metadata currently not supported, please delete and recreate pod with `kubectl delete pod %s -n %s`", pod_name, namespace)
                 return KubeboxPod(pod_name, namespace, kubebox=self)
             else:
-                logging.error(f"Error creating pod {pod_name}: {e}")
+                logging.error("Error creating pod %s: %s", pod_name, e)
                 raise e
 
-    def create_service(
+    async def _pod_exists(self, pod_name: str, namespace: str) -> bool:
+        try:
+            await self._call(
+                self._core_v1.read_namespaced_pod, name=pod_name, namespace=namespace
+            )
+        except ApiException as e:
+            if e.status == 404:
+                return False
+            raise
+        return True
+
+    async def create_service(
         self,
         pod_name: str,
         namespace: str = "default",
         username: str = None,
-        ports: list[int] = [],
+        ports: Sequence[int] = (),
     ):
-        logging.info(f"Creating service: {pod_name}-service in namespace: {namespace}")
+        logging.info("Creating service: %s-service in namespace: %s", pod_name, namespace)
 
         labels = {"app": pod_name}
         if username:
@@ -338,98 +786,45 @@ class Kubebox:
             },
             "spec": {
                 "selector": {"app": pod_name},
-                "ports": [
-                    {"name": "api", "protocol": "TCP", "port": 80, "targetPort": 80},
-                    *[
-                        {
-                            "name": f"dev-{port}",
-                            "protocol": "TCP",
-                            "port": port,
-                            "targetPort": port,
-                        }
-                        for port in ports
-                    ],
-                ],
+                "ports": list(_service_ports(tuple(ports))),
                 "type": "LoadBalancer",
                 "externalTrafficPolicy": "Local",
             },
         }
 
         try:
-            api_response = self._core_v1.create_namespaced_service(
-                namespace=namespace, body=service_manifest
+            # Applying only sets the fields in the manifest, so an existing
+            # service keeps its cluster IP and load balancer
+            await self._apply(
+                "/api/v1/namespaces/{namespace}/services",
+                service_name,
+                namespace,
+                service_manifest,
             )
-            logging.info(f"Service {service_name} created successfully")
+            logging.info("Service %s applied successfully", service_name)
             return KubeboxService(service_name, namespace, kubebox=self)
         except ApiException as e:
-            if e.status == 409:
-                logging.info(
-                    f"Service {service_name} already exists in namespace {namespace}"
-                )
-                try:
-                    # Patch the existing service (instead of replacing it)
-                    api_response = self._core_v1.patch_namespaced_service(
-                        name=service_name, namespace=namespace, body=service_manifest
-                    )
-                    logging.info(f"Service {service_name} updated successfully")
-                    return KubeboxService(service_name, namespace, kubebox=self)
-                except ApiException as update_e:
-                    logging.error(f"Error updating service {service_name}: {update_e}")
-                    raise update_e
-            else:
-                logging.error(f"Error creating service {service_name}: {e}")
-                raise e
+            logging.error("Error applying service %s: %s", service_name, e)
+            raise e
     
     def _load_kube_config_from_terraform(self, tfstate_file, kubebox_str, print_dict: bool = False):
         if tfstate_file:
-            with open(tfstate_file, "r") as f:
-                tfstate = json.load(f)
-
-            # Navigate the state file to find the kubeconfig data
-            resources = tfstate.get("resources", [])
-            kube_config = None
-
-            for resource in resources:
-                if resource.get("type") == "azurerm_kubernetes_cluster":
-                    for instance in resource.get("instances", []):
-                        attributes = instance.get("attributes", {})
-                        # Check for 'kube_config_raw' or 'kube_admin_config_raw'
-                        kube_config_raw = attributes.get(
-                            "kube_config_raw"
-                        ) or attributes.get("kube_admin_config_raw")
-                        if kube_config_raw:
-                            # Decode the base64-encoded kubeconfig
-                            # kube_config = base64.b64decode(kube_config_raw).decode('utf-8')
-                            kube_config = kube_config_raw
-                            break
-                    if kube_config:
-                        break
-
-            if not kube_config:
-                raise Exception("Failed to find kube_config in terraform state file.")
-
-            # Write the kubeconfig to a temporary file
-            kubeconfig_path = "/tmp/kubeconfig"
-            os.makedirs(os.path.dirname(kubeconfig_path), exist_ok=True)
-            with open(kubeconfig_path, "w") as f:
-                f.write(kube_config)
+            kube_config = read_kube_config_from_terraform(tfstate_file)
 
             if print_dict:
                 print(json.dumps(kube_config))
 
-            # Load the kubeconfig
-            config.load_kube_config(config_file=kubeconfig_path)
+            # Load the kubeconfig straight from memory; it holds credentials,
+            # so it is never written to disk
+            config.load_kube_config_from_dict(parse_kube_config(kube_config))
         elif kubebox_str:
-            kubeconfig_path = "/tmp/kubeconfig"
-            os.makedirs(os.path.dirname(kubeconfig_path), exist_ok=True)
-            with open(kubeconfig_path, "w") as f:
-                f.write(kubebox_str)
-            config.load_kube_config(config_file=kubeconfig_path)
+            config.load_kube_config_from_dict(parse_kube_config(kubebox_str))
         else:
             raise Exception("No kubeconfig provided.")
 
 
 if __name__ == "__main__":
+    from ._run import run
 
     def setup_logging():
         RESET = "\033[0m"
@@ -441,11 +836,17 @@ if __name__ == "__main__":
             "CRITICAL": "\033[41m",  # Red background
         }
 
+        def make_formatter(color):
+            log_fmt = f"{color}%(asctime)s - %(levelname)s - %(message)s{RESET}"
+            return logging.Formatter(log_fmt, datefmt="%Y-%m-%d %H:%M:%S")
+
         class CustomFormatter(logging.Formatter):
+            # One formatter per level, built once rather than per record
+            formatters = {level: make_formatter(color) for level, color in COLORS.items()}
+            default = make_formatter(RESET)
+
             def format(self, record):
-                log_fmt = f"{COLORS.get(record.levelname, RESET)}%(asctime)s - %(levelname)s - %(message)s{RESET}"
-                formatter = logging.Formatter(log_fmt, datefmt="%Y-%m-%d %H:%M:%S")
-                return formatter.format(record)
+                return self.formatters.get(record.levelname, self.default).format(record)
 
         # Set up the root logger
         logging.basicConfig(level=logging.INFO)
@@ -486,18 +887,23 @@ if __name__ == "__main__":
 
         # kubebox = Kubebox(terraform_path="../../apps/sandbox/terraform.tfstate", print_kubebox_str=True)
         kubebox = Kubebox(secret)
-        kubebox.create_secret(secret_name="kubebox-public-key", namespace="default", data={"KUBEBOX_PUBLIC_KEY": KUBEBOX_PUBLIC_KEY})
+        kubebox.start_cache()
+        await kubebox.create_secret(secret_name="kubebox-public-key", namespace="default", data={"KUBEBOX_PUBLIC_KEY": KUBEBOX_PUBLIC_KEY})
         
-        pod = kubebox.create_pod(name, username=username, kubebox_public_key_secret_name="kubebox-public-key", kubebox_public_key_key="KUBEBOX_PUBLIC_KEY")
-        service = kubebox.create_service(name, username=username)
+        pod, service = await asyncio.gather(
+            kubebox.create_pod(name, username=username, kubebox_public_key_secret_name="kubebox-public-key", kubebox_public_key_key="KUBEBOX_PUBLIC_KEY"),
+            kubebox.create_service(name, username=username),
+        )
 
-        await pod.wait_until_ready()
-        await service.wait_until_ready()
-        ip = await service.get_external_ip()
+        # The load balancer can be provisioned while the pod is starting
+        _, ip = await asyncio.gather(
+            pod.wait_until_ready(), service.get_external_ip(timeout=300)
+        )
         print(f"http://{ip}")
+        kubebox.close()
 
-        # pods = await kubebox.get_all_pods()
-        # services = await kubebox.get_all_services()
+        # pods = await kubebox.get_all_pods(label_selector=f"username={username}")
+        # services = await kubebox.get_all_services(label_selector=f"username={username}")
         # print(pods)
         # print(services)
 
@@ -508,4 +914,4 @@ if __name__ == "__main__":
         #     await service.destroy()
 
     setup_logging()
-    asyncio.run(main("luke-pod", "luke"))
+    run(main("luke-pod", "luke"))
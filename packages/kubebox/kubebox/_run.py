@@ -0,0 +1,15 @@
+import asyncio
+
+
+def run(main):
+    """asyncio.run, on uvloop when it is installed.
+
+    For the package's example entry points. uvloop stays optional: the
+    library never picks an event loop for its callers, and uvloop isn't
+    available on Windows.
+    """
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.run(main)
+    return uvloop.run(main)
@@ -1,13 +1,30 @@
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+import functools
+import os
+
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa, padding, x25519
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography.exceptions import InvalidSignature
 
 
-def generate_keys(print_keys: bool = False):
-    """Generate RSA private and public keys."""
-    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+def generate_keys(print_keys: bool = False, algorithm: str = "rsa"):
+    """Generate private and public keys.
+
+    `algorithm` is "rsa" (RSA-2048, for signing and encryption), "ed25519"
+    (signing only) or "x25519" (encryption only). The latter two are far
+    faster than RSA and put no limit on the packet size for encryption.
+    """
+    if algorithm == "ed25519":
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    elif algorithm == "x25519":
+        private_key = x25519.X25519PrivateKey.generate()
+    elif algorithm == "rsa":
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    else:
+        raise ValueError(f"Unsupported key algorithm: {algorithm}")
     public_key = private_key.public_key()
 
     # If true, print them in the .env format
@@ -22,10 +39,14 @@ def generate_keys(print_keys: bool = False):
             .replace("\n", "\\n")
         )
 
+        # PKCS1 only exists for RSA keys
+        public_format = (
+            serialization.PublicFormat.PKCS1
+            if algorithm == "rsa"
+            else serialization.PublicFormat.SubjectPublicKeyInfo
+        )
         public_key_str = (
-            public_key.public_bytes(
-                serialization.Encoding.PEM, serialization.PublicFormat.PKCS1
-            )
+            public_key.public_bytes(serialization.Encoding.PEM, public_format)
             .decode()
             .replace("\n", "\\n")
         )
@@ -35,36 +56,46 @@ def generate_keys(print_keys: bool = False):
     return private_key, public_key
 
 
+# Parsing a PEM key is far slower than the sign/verify it is used for, and
+# callers pass the same configured key for every packet
+@functools.lru_cache(maxsize=32)
+def _load_pem_private_key(private_key: str):
+    return serialization.load_pem_private_key(
+        private_key.encode(),
+        password=None,
+        backend=default_backend()
+    )
+
+
+@functools.lru_cache(maxsize=32)
+def _load_pem_public_key(public_key: str):
+    return serialization.load_pem_public_key(
+        public_key.encode(),
+        backend=default_backend()
+    )
+
+
 def load_private_key(private_key):
     """Load a private key from a PEM string or return the key if it's already an object."""
     if isinstance(private_key, str):
-        private_key = serialization.load_pem_private_key(
-            private_key.encode(),
-            password=None,
-            backend=default_backend()
-        )
+        private_key = _load_pem_private_key(private_key)
     return private_key
 
 
 def load_public_key(public_key):
     """Load a public key from a PEM string or return the key if it's already an object."""
     if isinstance(public_key, str):
-        public_key = serialization.load_pem_public_key(
-            public_key.encode(),
-            backend=default_backend()
-        )
+        public_key = _load_pem_public_key(public_key)
     return public_key
 
 
 def sign_packet(packet: bytes, private_key):
     """Sign a packet using the provided private key."""
     private_key = load_private_key(private_key)
-    packet_hash = hashes.Hash(hashes.SHA256())
-    packet_hash.update(packet)
-    digest = packet_hash.finalize()
-
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        return private_key.sign(packet)
     signature = private_key.sign(
-        digest,
+        packet,
         padding.PSS(
             mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH
         ),
@@ -76,14 +107,13 @@ def sign_packet(packet: bytes, private_key):
 def verify_packet(packet: bytes, signature: bytes, public_key):
     """Verify a packet using the provided public key."""
     public_key = load_public_key(public_key)
-    packet_hash = hashes.Hash(hashes.SHA256())
-    packet_hash.update(packet)
-    digest = packet_hash.finalize()
-
     try:
+        if isinstance(public_key, ed25519.Ed25519PublicKey):
+            public_key.verify(signature, packet)
+            return True
         public_key.verify(
             signature,
-            digest,
+            packet,
             padding.PSS(
                 mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH
             ),
@@ -94,9 +124,27 @@ def verify_packet(packet: bytes, signature: bytes, public_key):
         return False
 
 
+def _packet_key(shared_key: bytes) -> ChaCha20Poly1305:
+    key = HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"kubebox-v1"
+    ).derive(shared_key)
+    return ChaCha20Poly1305(key)
+
+
 def encrypt_packet(packet: bytes, public_key):
     """Encrypt a packet using the recipient's public key."""
     public_key = load_public_key(public_key)
+    if isinstance(public_key, x25519.X25519PublicKey):
+        # Ephemeral X25519 key exchange, then ChaCha20-Poly1305. Output is
+        # the ephemeral public key (32 bytes), the nonce (12) and the
+        # ciphertext, which authenticates the ephemeral key too
+        ephemeral_key = x25519.X25519PrivateKey.generate()
+        ephemeral_public = ephemeral_key.public_key().public_bytes(
+            serialization.Encoding.Raw, serialization.PublicFormat.Raw
+        )
+        nonce = os.urandom(12)
+        cipher = _packet_key(ephemeral_key.exchange(public_key))
+        return ephemeral_public + nonce + cipher.encrypt(nonce, packet, ephemeral_public)
     encrypted_packet = public_key.encrypt(
         packet,
         padding.OAEP(
@@ -111,6 +159,15 @@ def encrypt_packet(packet: bytes, public_key):
 def decrypt_packet(encrypted_packet: bytes, private_key):
     """Decrypt a packet using the recipient's private key."""
     private_key = load_private_key(private_key)
+    if isinstance(private_key, x25519.X25519PrivateKey):
+        ephemeral_public = encrypted_packet[:32]
+        nonce = encrypted_packet[32:44]
+        shared_key = private_key.exchange(
+            x25519.X25519PublicKey.from_public_bytes(ephemeral_public)
+        )
+        return _packet_key(shared_key).decrypt(
+            nonce, encrypted_packet[44:], ephemeral_public
+        )
     decrypted_packet = private_key.decrypt(
         encrypted_packet,
         padding.OAEP(
@@ -131,6 +188,16 @@ if __name__ == "__main__":
     is_verified = verify_packet(packet, signature, public_key)
     print("Packet is verified as coming from the API:", is_verified)
 
+    signing_key, verifying_key = generate_keys(algorithm="ed25519")
+    signature = sign_packet(packet, signing_key)
+    is_verified = verify_packet(packet, signature, verifying_key)
+    print("Packet is verified with Ed25519:", is_verified)
+
     encrypted_packet = encrypt_packet(packet, public_key)
     decrypted_packet = decrypt_packet(encrypted_packet, private_key)
     print("Decrypted packet:", decrypted_packet)
+
+    private_key, public_key = generate_keys(algorithm="x25519")
+    encrypted_packet = encrypt_packet(packet * 1000, public_key)
+    decrypted_packet = decrypt_packet(encrypted_packet, private_key)
+    print("Decrypted X25519 packet matches:", decrypted_packet == packet * 1000)
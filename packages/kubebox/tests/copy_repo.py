@@ -1,6 +1,8 @@
+import asyncio
 import os
 from dotenv import load_dotenv
 from kubebox import Kubebox, SandboxClient, CommandMode
+from kubebox._run import run
 
 load_dotenv()
 KUBEBOX_CONFIG = os.getenv("KUBEBOX_CONFIG")
@@ -8,11 +10,13 @@ KUBEBOX_CONFIG = os.getenv("KUBEBOX_CONFIG")
 
 async def main():
     kubebox = Kubebox(KUBEBOX_CONFIG)
-    pod = kubebox.create_pod("test-pod", username="test-user")
-    service = kubebox.create_service("test-pod", username="test-user", ports=[3000])
-    await pod.wait_until_ready()
-    await service.wait_until_ready()
-    ip = await service.get_external_ip()
+    pod, service = await asyncio.gather(
+        kubebox.create_pod("test-pod", username="test-user"),
+        kubebox.create_service("test-pod", username="test-user", ports=[3000]),
+    )
+    _, ip = await asyncio.gather(
+        pod.wait_until_ready(), service.get_external_ip(timeout=300)
+    )
     print(f"http://{ip}")
 
     client = SandboxClient(f"http://{ip}")
@@ -36,8 +40,7 @@ async def main():
         mode=CommandMode.STREAM,
         path="test_path",
     )
-    async for output in result:
-        print(output.output)
+    await result.echo()
 
     result = await client.run_command(
         "test-session",
@@ -45,11 +48,8 @@ async def main():
         mode=CommandMode.STREAM,
         path="test_path",
     )
-    async for output in result:
-        print(output.output)
+    await result.echo()
 
 
 if __name__ == "__main__":
-    import asyncio
-
-    asyncio.run(main())
+    run(main())